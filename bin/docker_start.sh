@@ -18,6 +18,7 @@ python manage.py makemigrations && \
   python manage.py collectstatic --noinput  && \
   python manage.py compress --force && \
   python manage.py build_index && \
+  python manage.py build_sitemap && \
   python manage.py compilemessages
 
 exec gunicorn ${DJANGO_WSGI_MODULE}:application \
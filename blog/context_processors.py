@@ -2,21 +2,33 @@ import logging
 
 from django.utils import timezone
 
-from djangoblog.utils import cache, get_blog_setting
-from .models import Category, Article
+from djangoblog.utils import get_blog_setting, get_or_set_cache, make_tagged_cache_key
+from .models import Article, CategoryTree
 
 logger = logging.getLogger(__name__)
 
 
+def get_nav_categories():
+    """
+    根据分类目录树组装导航使用的分类树
+    :return: 顶级分类列表,子分类在children中
+    """
+    tree = CategoryTree.get()
+
+    def to_node(category):
+        return {'pk': category.pk, 'name': category.name, 'url': category.get_absolute_url(),
+                'children': [to_node(c) for c in tree.get_children(category.pk)]}
+
+    return [to_node(c) for c in tree.get_roots()]
+
+
 def seo_processor(requests):
-    key = 'seo_processor'
-    value = cache.get(key)
-    if value:
-        return value
-    else:
+    key = make_tagged_cache_key('seo_processor', ['blog_setting', 'category', 'article'])
+
+    def compute():
         logger.info('set processor cache.')
         setting = get_blog_setting()
-        value = {
+        return {
             'SITE_NAME': setting.site_name,
             'SHOW_GOOGLE_ADSENSE': setting.show_google_adsense,
             'GOOGLE_ADSENSE_CODES': setting.google_adsense_codes,
@@ -25,10 +37,10 @@ def seo_processor(requests):
             'SITE_KEYWORDS': setting.site_keywords,
             'SITE_BASE_URL': requests.scheme + '://' + requests.get_host() + '/',
             'ARTICLE_SUB_LENGTH': setting.article_sub_length,
-            'nav_category_list': Category.objects.all(),
-            'nav_pages': Article.objects.filter(
-                type='p',
-                status='p'),
+            'nav_category_list': get_nav_categories(),
+            'nav_pages': [
+                {'pk': a.pk, 'title': a.title, 'url': a.get_absolute_url()}
+                for a in Article.objects.filter(type='p', status='p').links()],
             'OPEN_SITE_COMMENT': setting.open_site_comment,
             'BEIAN_CODE': setting.beian_code,
             'ANALYTICS_CODE': setting.analytics_code,
@@ -39,5 +51,5 @@ def seo_processor(requests):
             "GLOBAL_FOOTER": setting.global_footer,
             "COMMENT_NEED_REVIEW": setting.comment_need_review,
         }
-        cache.set(key, value, 60 * 60 * 10)
-        return value
+
+    return get_or_set_cache(key, compute, 60 * 60 * 10, soft_expiration=60 * 60 * 9, single_flight=True)
@@ -0,0 +1,78 @@
+import logging
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from djangoblog.utils import BackgroundFlusher
+
+logger = logging.getLogger(__name__)
+
+
+class ArticleViewCounter:
+    """
+    文章阅读数计数器
+    阅读数先在进程内累加,由后台线程定期用 views=F('views')+n 批量写入数据库,
+    避免每次访问都同步更新同一行,也不会因为写入绝对值而丢失并发的计数
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._flusher = BackgroundFlusher('article-views-flusher', self.flush, interval)
+
+    def incr(self, article_id, count=1):
+        """
+        增加阅读数
+        :return: 该文章尚未写入数据库的阅读数
+        """
+        with self._lock:
+            self._pending[article_id] += count
+            pending = self._pending[article_id]
+        if self.interval > 0:
+            self._flusher.start()
+        else:
+            self.flush()
+        return pending
+
+    def get_pending(self, article_ids):
+        """
+        获得尚未写入数据库的阅读数
+        :param article_ids: 文章id列表
+        :return: {id: 阅读数}
+        """
+        with self._lock:
+            return {pk: self._pending[pk] for pk in article_ids if pk in self._pending}
+
+    def flush(self):
+        """
+        将缓冲的阅读数批量写入数据库,相同增量的文章合并为一条update
+        :return: 写入的阅读数
+        """
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return 0
+        batches = defaultdict(list)
+        for article_id, count in pending.items():
+            batches[count].append(article_id)
+        from blog.models import Article
+        try:
+            with transaction.atomic():
+                for count, ids in batches.items():
+                    Article.objects.filter(pk__in=ids).update(views=F('views') + count)
+        except Exception:
+            # 写入失败则放回缓冲区,下次重试
+            with self._lock:
+                self._pending.update(pending)
+            raise
+        total = sum(pending.values())
+        logger.info('flush article views:{total} views of {count} articles'.format(
+            total=total, count=len(pending)))
+        return total
+
+
+article_view_counter = ArticleViewCounter(settings.ARTICLE_VIEWS_FLUSH_INTERVAL)
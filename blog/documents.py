@@ -1,4 +1,9 @@
+import logging
+import random
+import threading
 import time
+import uuid
+from collections import deque
 
 import elasticsearch.client
 from django.conf import settings
@@ -6,6 +11,9 @@ from elasticsearch_dsl import Document, InnerDoc, Date, Integer, Long, Text, Obj
 from elasticsearch_dsl.connections import connections
 
 from blog.models import Article
+from djangoblog.utils import BackgroundFlusher
+
+logger = logging.getLogger(__name__)
 
 ELASTICSEARCH_ENABLED = hasattr(settings, 'ELASTICSEARCH_DSL')
 
@@ -83,23 +91,28 @@ class ElapsedTimeDocument(Document):
 
 
 class ElaspedTimeDocumentManager:
+    _index_built = False
+
     @staticmethod
     def build_index():
+        if ElaspedTimeDocumentManager._index_built:
+            return
         from elasticsearch import Elasticsearch
         client = Elasticsearch(settings.ELASTICSEARCH_DSL['default']['hosts'])
         res = client.indices.exists(index="performance")
         if not res:
             ElapsedTimeDocument.init()
+        ElaspedTimeDocumentManager._index_built = True
 
     @staticmethod
     def delete_index():
         from elasticsearch import Elasticsearch
         es = Elasticsearch(settings.ELASTICSEARCH_DSL['default']['hosts'])
         es.indices.delete(index='performance', ignore=[400, 404])
+        ElaspedTimeDocumentManager._index_built = False
 
     @staticmethod
-    def create(url, time_taken, log_datetime, useragent, ip):
-        ElaspedTimeDocumentManager.build_index()
+    def to_doc(url, time_taken, log_datetime, useragent, ip):
         ua = UserAgent()
         ua.browser = UserAgentBrowser()
         ua.browser.Family = useragent.browser.family
@@ -116,20 +129,95 @@ class ElaspedTimeDocumentManager:
         ua.string = useragent.ua_string
         ua.is_bot = useragent.is_bot
 
-        doc = ElapsedTimeDocument(
-            meta={
-                'id': int(
-                    round(
-                        time.time() *
-                        1000))
-            },
+        # 同一批记录在同一毫秒内转换,不能再用时间戳作为id
+        return ElapsedTimeDocument(
+            meta={'id': uuid.uuid4().hex},
             url=url,
             time_taken=time_taken,
             log_datetime=log_datetime,
             useragent=ua, ip=ip)
+
+    @staticmethod
+    def create(url, time_taken, log_datetime, useragent, ip):
+        ElaspedTimeDocumentManager.build_index()
+        doc = ElaspedTimeDocumentManager.to_doc(url, time_taken, log_datetime, useragent, ip)
         doc.save(pipeline="geoip")
 
 
+class ElapsedTimeShipper:
+    """
+    页面耗时记录发送器
+    请求中只把记录放入有界缓冲区,由后台线程通过bulk api批量写入ES.
+    缓冲区满时直接丢弃新记录,不阻塞请求
+    """
+
+    def __init__(self, interval, buffer_size, sample_rate):
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.sample_rate = sample_rate
+        self.shipped = 0
+        self.dropped = 0
+        self.failed = 0
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._flusher = BackgroundFlusher('elapsed-time-shipper', self.flush, interval)
+
+    def record(self, url, time_taken, log_datetime, useragent, ip):
+        """
+        记录一次请求耗时
+        :param useragent: 原始的User-Agent字符串,在后台线程中解析
+        :return: 是否放入缓冲区
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        with self._lock:
+            if len(self._buffer) >= self.buffer_size:
+                self.dropped += 1
+                return False
+            self._buffer.append((url, time_taken, log_datetime, useragent, ip))
+        self._flusher.start()
+        return True
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._buffer),
+                'shipped': self.shipped,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+
+    def flush(self):
+        """
+        批量写入缓冲区中的记录
+        :return: 写入成功的记录数
+        """
+        with self._lock:
+            records, self._buffer = self._buffer, deque()
+        if not records:
+            return 0
+        from elasticsearch.helpers import streaming_bulk
+        from djangoblog.utils import parse_user_agent
+        ElaspedTimeDocumentManager.build_index()
+        actions = (
+            ElaspedTimeDocumentManager.to_doc(
+                url, time_taken, log_datetime, parse_user_agent(useragent), ip).to_dict(include_meta=True)
+            for url, time_taken, log_datetime, useragent, ip in records)
+        shipped = 0
+        try:
+            for ok, item in streaming_bulk(
+                    connections.get_connection(), actions, pipeline='geoip', raise_on_error=False):
+                if ok:
+                    shipped += 1
+                else:
+                    logger.error('ship elapsed time error:{item}'.format(item=item))
+        finally:
+            with self._lock:
+                self.shipped += shipped
+                self.failed += len(records) - shipped
+        return shipped
+
+
 class ArticleDocument(Document):
     body = Text(analyzer='ik_max_word', search_analyzer='ik_smart')
     title = Text(analyzer='ik_max_word', search_analyzer='ik_smart')
@@ -177,37 +265,90 @@ class ArticleDocumentManager():
         es = Elasticsearch(settings.ELASTICSEARCH_DSL['default']['hosts'])
         es.indices.delete(index='blog', ignore=[400, 404])
 
+    @staticmethod
+    def get_queryset():
+        """建索引所需的作者,分类和标签随文章一起加载"""
+        return Article.objects.select_related('author', 'category').prefetch_related('tags')
+
+    def to_doc(self, article):
+        return ArticleDocument(
+            meta={
+                'id': article.id},
+            body=article.body,
+            title=article.title,
+            author={
+                'nickname': article.author.username,
+                'id': article.author.id},
+            category={
+                'name': article.category.name,
+                'id': article.category.id},
+            tags=[
+                {
+                    'name': t.name,
+                    'id': t.id} for t in article.tags.all()],
+            pub_time=article.pub_time,
+            status=article.status,
+            comment_status=article.comment_status,
+            type=article.type,
+            views=article.views,
+            article_order=article.article_order)
+
     def convert_to_doc(self, articles):
-        return [
-            ArticleDocument(
-                meta={
-                    'id': article.id},
-                body=article.body,
-                title=article.title,
-                author={
-                    'nickname': article.author.username,
-                    'id': article.author.id},
-                category={
-                    'name': article.category.name,
-                    'id': article.category.id},
-                tags=[
-                    {
-                        'name': t.name,
-                        'id': t.id} for t in article.tags.all()],
-                pub_time=article.pub_time,
-                status=article.status,
-                comment_status=article.comment_status,
-                type=article.type,
-                views=article.views,
-                article_order=article.article_order) for article in articles]
-
-    def rebuild(self, articles=None):
+        return [self.to_doc(article) for article in articles]
+
+    def rebuild(self, articles=None, chunk_size=500, thread_count=1):
+        """
+        重建索引.文章分批从数据库流式读取,转换后通过bulk api写入,
+        写入期间关闭索引刷新
+        :param articles: 要索引的文章,默认所有文章
+        :param chunk_size: 每次读取和写入的文章数
+        :param thread_count: 并行写入的线程数
+        :return: (写入的文档数, 耗时秒数)
+        """
         ArticleDocument.init()
-        articles = articles if articles else Article.objects.all()
-        docs = self.convert_to_doc(articles)
-        for doc in docs:
-            doc.save()
+        if articles is None:
+            articles = self.get_queryset().iterator(chunk_size=chunk_size)
+        docs = (self.to_doc(article) for article in articles)
+
+        index = ArticleDocument._index
+        index.put_settings(body={'index': {'refresh_interval': '-1'}})
+        try:
+            start = time.time()
+            count = self.bulk_save(docs, chunk_size, thread_count)
+            elapsed = time.time() - start
+        finally:
+            index.put_settings(body={'index': {'refresh_interval': None}})
+            index.refresh()
+        logger.info('rebuild article index:{count} docs in {elapsed:.2f}s,{rate:.0f} docs/s'.format(
+            count=count, elapsed=elapsed, rate=count / elapsed if elapsed else 0))
+        return count, elapsed
 
     def update_docs(self, docs):
-        for doc in docs:
-            doc.save()
+        self.bulk_save(docs)
+
+    @staticmethod
+    def bulk_save(docs, chunk_size=500, thread_count=1):
+        """
+        通过bulk api批量写入文档
+        :return: 写入成功的文档数
+        """
+        from elasticsearch.helpers import parallel_bulk, streaming_bulk
+        client = connections.get_connection()
+        actions = (doc.to_dict(include_meta=True) for doc in docs)
+        if thread_count > 1:
+            results = parallel_bulk(client, actions, thread_count=thread_count, chunk_size=chunk_size)
+        else:
+            results = streaming_bulk(client, actions, chunk_size=chunk_size)
+        count = 0
+        for ok, item in results:
+            if ok:
+                count += 1
+            else:
+                logger.error('bulk index error:{item}'.format(item=item))
+        return count
+
+
+elapsed_time_shipper = ElapsedTimeShipper(
+    settings.ELAPSED_TIME_SHIP_INTERVAL,
+    settings.ELAPSED_TIME_BUFFER_SIZE,
+    settings.ELAPSED_TIME_SAMPLE_RATE)
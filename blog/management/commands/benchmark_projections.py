@@ -0,0 +1,81 @@
+import time
+import tracemalloc
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from blog.models import Article
+
+
+def fetched_bytes(queries):
+    """重新执行查询,统计返回的数据量"""
+    total = 0
+    with connection.cursor() as cursor:
+        for query in queries:
+            if not query['sql'].startswith('SELECT'):
+                continue
+            cursor.execute(query['sql'])
+            for row in cursor.fetchall():
+                total += sum(len(value) if isinstance(value, (str, bytes)) else len(str(value))
+                             for value in row if value is not None)
+    return total
+
+
+def measure(func, repeat):
+    tracemalloc.start()
+    start = time.perf_counter()
+    with CaptureQueriesContext(connection) as context:
+        for i in range(repeat):
+            func()
+    elapsed = (time.perf_counter() - start) / repeat
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    queries = context.captured_queries[:len(context.captured_queries) // repeat]
+    return {
+        'queries': len(queries),
+        'bytes': fetched_bytes(queries),
+        'memory': peak,
+        'ms': elapsed * 1000,
+    }
+
+
+class Command(BaseCommand):
+    help = 'compare full-row article queries with the links()/cards() projections'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='run each query this many times and report the average time')
+
+    def handle(self, *args, **options):
+        published = Article.objects.filter(status='p')
+        cases = [
+            ('sidebar articles',
+             lambda: list(published[:10]),
+             lambda: list(published.links('views')[:10])),
+            ('nav pages',
+             lambda: [a.get_absolute_url() for a in published.filter(type='p')],
+             lambda: [a.get_absolute_url() for a in published.filter(type='p').links()]),
+            ('article sitemap',
+             lambda: [(a.get_absolute_url(), a.last_modify_time) for a in published],
+             lambda: [(a.get_absolute_url(), a.last_modify_time) for a in published.links('last_modify_time')]),
+            ('user sitemap',
+             lambda: list(set(map(lambda x: x.author, Article.objects.all()))),
+             lambda: list(get_user_model().objects.filter(article__isnull=False).distinct().only(
+                 'id', 'username', 'date_joined'))),
+            ('blog api recent',
+             lambda: list(Article.objects.all()[:8]),
+             lambda: list(Article.objects.cards('body')[:8])),
+        ]
+        row = '{:<18}{:>16}{:>24}{:>24}{:>20}\n'
+        self.stdout.write(row.format('case', 'queries', 'fetched bytes', 'peak memory', 'ms'))
+        for name, full, projected in cases:
+            before = measure(full, options['repeat'])
+            after = measure(projected, options['repeat'])
+            self.stdout.write(row.format(name, *[
+                '{0} -> {1}'.format(round(before[key], 1), round(after[key], 1))
+                for key in ('queries', 'bytes', 'memory', 'ms')]))
@@ -4,10 +4,21 @@ from blog.documents import ElapsedTimeDocument, ArticleDocumentManager, ElaspedT
     ELASTICSEARCH_ENABLED
 
 
-# TODO 参数化
 class Command(BaseCommand):
     help = 'build search index'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='number of articles read and indexed per bulk request')
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=1,
+            help='number of threads sending bulk requests')
+
     def handle(self, *args, **options):
         if ELASTICSEARCH_ENABLED:
             ElaspedTimeDocumentManager.build_index()
@@ -15,4 +26,10 @@ class Command(BaseCommand):
             manager.init()
             manager = ArticleDocumentManager()
             manager.delete_index()
-            manager.rebuild()
+            count, elapsed = manager.rebuild(
+                chunk_size=options['chunk_size'],
+                thread_count=options['threads'])
+            self.stdout.write(
+                self.style.SUCCESS(
+                    'indexed %d articles in %.2fs, %.0f docs/s' %
+                    (count, elapsed, count / elapsed if elapsed else 0)))
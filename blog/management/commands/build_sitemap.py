@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from djangoblog.sitemap import sitemap_generator
+
+
+class Command(BaseCommand):
+    help = 'generate the static sitemap index and shards'
+
+    def handle(self, *args, **options):
+        count = sitemap_generator.generate()
+        self.stdout.write(self.style.SUCCESS('generated {count} sitemap shards'.format(count=count)))
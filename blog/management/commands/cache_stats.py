@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from djangoblog.utils import cache
+
+
+class Command(BaseCommand):
+    help = 'show hit/miss statistics of each cache tier'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='reset the statistics after showing them')
+
+    def handle(self, *args, **options):
+        if not hasattr(cache, 'get_stats'):
+            self.stdout.write('the cache backend does not collect statistics\n')
+            return
+        stats = cache.get_stats()
+        for tier in ('l1', 'l2'):
+            self.stdout.write(
+                '{tier}: hits {hits}, misses {misses}, hit rate {hit_rate:.2%}\n'.format(
+                    tier=tier, **stats[tier]))
+        self.stdout.write('invalidations received: {n}\n'.format(n=stats['invalidations']))
+        if options['reset']:
+            cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS('Reset cache statistics\n'))
@@ -46,5 +46,5 @@ class Command(BaseCommand):
             self.style.SUCCESS(
                 'start notify %d urls' %
                 len(urls)))
-        SpiderNotify.baidu_notify(urls)
-        self.stdout.write(self.style.SUCCESS('finish notify'))
+        count = SpiderNotify.baidu_notify(urls)
+        self.stdout.write(self.style.SUCCESS('finish notify %d urls' % count))
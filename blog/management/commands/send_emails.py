@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from servermanager.outbox import email_outbox
+
+
+class Command(BaseCommand):
+    help = 'send pending emails in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='keep running and check the outbox every --interval seconds')
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=10,
+            help='seconds to wait between two checks when --loop is given')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = email_outbox.flush()
+            if sent or failed:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        'sent %d emails, %d failed' %
+                        (sent, failed)))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -1,10 +1,13 @@
 import logging
 import time
+from contextlib import ExitStack
 
+from django.db import connections
+from django.utils.functional import SimpleLazyObject
 from ipware import get_client_ip
-from user_agents import parse
 
-from blog.documents import ELASTICSEARCH_ENABLED, ElaspedTimeDocumentManager
+from blog.documents import ELASTICSEARCH_ENABLED, elapsed_time_shipper
+from djangoblog.utils import parse_user_agent, request_timing, start_request_timings, stop_request_timings
 
 logger = logging.getLogger(__name__)
 
@@ -17,26 +20,50 @@ class OnlineMiddleware(object):
     def __call__(self, request):
         ''' page render time '''
         start_time = time.time()
-        response = self.get_response(request)
-        http_user_agent = request.META.get('HTTP_USER_AGENT', '')
-        ip, _ = get_client_ip(request)
-        user_agent = parse(http_user_agent)
+        # User-Agent只在用到时才解析
+        request.user_agent = SimpleLazyObject(
+            lambda: parse_user_agent(request.META.get('HTTP_USER_AGENT', '')))
+        token = start_request_timings()
+        try:
+            with ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(self.db_timer))
+                response = self.get_response(request)
+        finally:
+            timings = stop_request_timings(token)
+        cast_time = time.time() - start_time
+        timings['total'] = cast_time
+        response['Server-Timing'] = ', '.join(
+            '{name};dur={dur:.1f}'.format(name=name, dur=seconds * 1000)
+            for name, seconds in timings.items())
+
         if not response.streaming:
             try:
-                cast_time = time.time() - start_time
                 if ELASTICSEARCH_ENABLED:
                     time_taken = round((cast_time) * 1000, 2)
                     url = request.path
+                    ip, _ = get_client_ip(request)
                     from django.utils import timezone
-                    ElaspedTimeDocumentManager.create(
+                    # 只放入缓冲区,由后台线程批量写入ES
+                    elapsed_time_shipper.record(
                         url=url,
                         time_taken=time_taken,
                         log_datetime=timezone.now(),
-                        useragent=user_agent,
+                        useragent=request.META.get('HTTP_USER_AGENT', ''),
                         ip=ip)
-                response.content = response.content.replace(
-                    b'<!!LOAD_TIMES!!>', str.encode(str(cast_time)[:5]))
             except Exception as e:
                 logger.error("Error OnlineMiddleware: %s" % e)
 
         return response
+
+    @staticmethod
+    def db_timer(execute, sql, params, many, context):
+        with request_timing('db'):
+            return execute(sql, params, many, context)
+
+    def process_template_response(self, request, response):
+        # 在这里渲染以便单独统计模板耗时,之后Django不会重复渲染
+        if not response.is_rendered:
+            with request_timing('template'):
+                response.render()
+        return response
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.14 on 2026-10-17 04:08
+
+import html
+
+from django.db import migrations, models
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+
+
+def render_article_bodies(apps, schema_editor):
+    from djangoblog.utils import CommonMarkdown, get_sha256
+    Article = apps.get_model('blog', 'Article')
+    for article in Article.objects.only('id', 'body').iterator():
+        article.body_html, article.body_toc = CommonMarkdown.get_markdown_with_toc(article.body)
+        article.body_excerpt = Truncator(html.unescape(strip_tags(article.body_html))).chars(200)
+        article.body_hash = get_sha256(article.body)
+        article.save(update_fields=['body_html', 'body_toc', 'body_excerpt', 'body_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0007_alter_sidebar_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='body_excerpt',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='body excerpt'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='body_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64, verbose_name='body hash'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='body_html',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='body html'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='body_toc',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='body toc'),
+        ),
+        migrations.RunPython(render_article_bodies, migrations.RunPython.noop),
+    ]
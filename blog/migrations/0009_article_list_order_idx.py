@@ -0,0 +1,21 @@
+# Generated by Django 4.2.14 on 2026-10-17 04:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0008_article_body_excerpt_article_body_hash_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='article',
+            options={'get_latest_by': 'id', 'ordering': ['-article_order', '-pub_time', '-id'], 'verbose_name': 'article', 'verbose_name_plural': 'article'},
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['article_order', 'pub_time', 'id'], name='blog_article_list_order_idx'),
+        ),
+    ]
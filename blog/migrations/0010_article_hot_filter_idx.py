@@ -0,0 +1,29 @@
+# Generated by Django 4.2.14 on 2026-10-17 04:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0009_article_list_order_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['type', 'status', 'article_order', 'pub_time', 'id'], name='blog_article_type_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['status', 'article_order', 'pub_time', 'id'], name='blog_article_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['category', 'status', 'article_order', 'pub_time', 'id'], name='blog_article_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['status', 'views'], name='blog_article_status_views_idx'),
+        ),
+    ]
@@ -1,17 +1,24 @@
+import html
 import logging
 from abc import abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.urls import reverse
-from django.utils.timezone import now
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+from django.utils.timezone import is_aware, localtime, now
 from django.utils.translation import gettext_lazy as _
 from mdeditor.fields import MDTextField
 from uuslug import slugify
 
-from djangoblog.utils import cache_decorator, cache
-from djangoblog.utils import get_current_site
+from djangoblog.utils import cache_decorator, cache, cache_lock, cache_tag, invalidate_cache_tags, \
+    make_tagged_cache_key
+from djangoblog.utils import get_current_site, get_sha256, CommonMarkdown
 
 logger = logging.getLogger(__name__)
 
@@ -57,6 +64,54 @@ class BaseModel(models.Model):
         pass
 
 
+class ArticleQuerySet(models.QuerySet):
+    def seek(self, cursor, reverse=False):
+        '''
+        游标分页,获得排在游标位置之后的文章,不需要OFFSET扫描并丢弃前面的行
+        :param cursor: Article.get_list_cursor()生成的游标
+        :param reverse: 为True时获得排在游标位置之前的文章,按相反顺序排列
+        '''
+        article_order, pub_time, pk = Article.parse_list_cursor(cursor)
+        if reverse:
+            return self.filter(
+                models.Q(article_order__gt=article_order) |
+                models.Q(article_order=article_order, pub_time__gt=pub_time) |
+                models.Q(article_order=article_order, pub_time=pub_time, id__gt=pk)
+            ).order_by(*[f.lstrip('-') for f in Article._meta.ordering])
+        return self.filter(
+            models.Q(article_order__lt=article_order) |
+            models.Q(article_order=article_order, pub_time__lt=pub_time) |
+            models.Q(article_order=article_order, pub_time=pub_time, id__lt=pk)
+        ).order_by(*Article._meta.ordering)
+
+    # 标题链接只需要标题和生成url的字段
+    LINK_FIELDS = ('id', 'title', 'creation_time')
+    # 卡片另外显示时间、阅读数和摘要,不含正文
+    CARD_FIELDS = LINK_FIELDS + ('pub_time', 'last_modify_time', 'views', 'status', 'type', 'body_excerpt')
+
+    def links(self, *fields):
+        '''
+        只显示标题链接时使用,不加载正文等大字段
+        :param fields: 额外需要的字段
+        '''
+        return self.only(*self.LINK_FIELDS, *fields)
+
+    def cards(self, *fields):
+        '''
+        显示文章卡片(标题,时间,摘要)时使用,不加载正文
+        :param fields: 额外需要的字段
+        '''
+        return self.only(*self.CARD_FIELDS, *fields)
+
+    def for_list(self):
+        '''
+        文章列表页使用的queryset
+        一次性加载作者,分类,标签及评论数,避免模板中逐篇文章查询
+        '''
+        return self.select_related('author', 'category').prefetch_related('tags').annotate(
+            enabled_comment_count=models.Count('comment', filter=models.Q(comment__is_enable=True)))
+
+
 class Article(BaseModel):
     """文章"""
     STATUS_CHOICES = (
@@ -103,6 +158,18 @@ class Article(BaseModel):
         blank=False,
         null=False)
     tags = models.ManyToManyField('Tag', verbose_name=_('tag'), blank=True)
+    # 预渲染的正文,仅在body变化时重新生成,避免每次请求都渲染markdown
+    body_html = models.TextField(_('body html'), blank=True, default='', editable=False)
+    body_toc = models.TextField(_('body toc'), blank=True, default='', editable=False)
+    body_excerpt = models.TextField(_('body excerpt'), blank=True, default='', editable=False)
+    body_hash = models.CharField(_('body hash'), max_length=64, blank=True, default='', editable=False)
+
+    objects = ArticleQuerySet.as_manager()
+
+    EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc if settings.USE_TZ else None)
+
+    RENDERED_BODY_FIELDS = ('body_html', 'body_toc', 'body_excerpt', 'body_hash')
+    EXCERPT_LENGTH = 200
 
     def body_to_string(self):
         return self.body
@@ -111,10 +178,50 @@ class Article(BaseModel):
         return self.title
 
     class Meta:
-        ordering = ['-article_order', '-pub_time']
+        # id保证排序唯一,游标分页依赖这一点
+        ordering = ['-article_order', '-pub_time', '-id']
         verbose_name = _('article')
         verbose_name_plural = verbose_name
         get_latest_by = 'id'
+        indexes = [
+            models.Index(fields=['article_order', 'pub_time', 'id'], name='blog_article_list_order_idx'),
+            # 首页列表 filter(type, status) 按列表顺序排序
+            models.Index(fields=['type', 'status', 'article_order', 'pub_time', 'id'],
+                         name='blog_article_type_status_idx'),
+            # 侧边栏最新文章,归档
+            models.Index(fields=['status', 'article_order', 'pub_time', 'id'],
+                         name='blog_article_status_idx'),
+            # 分类列表
+            models.Index(fields=['category', 'status', 'article_order', 'pub_time', 'id'],
+                         name='blog_article_category_idx'),
+            # 侧边栏最热文章
+            models.Index(fields=['status', 'views'], name='blog_article_status_views_idx'),
+        ]
+
+    def get_list_cursor(self):
+        """
+        文章在列表排序中的位置,用于游标分页
+        :return: article_order_pub_time微秒数_id
+        """
+        pub_time = self.pub_time - self.EPOCH
+        microseconds = (pub_time.days * 86400 + pub_time.seconds) * 10 ** 6 + pub_time.microseconds
+        return '{order}_{time}_{id}'.format(order=self.article_order, time=microseconds, id=self.id)
+
+    @classmethod
+    def parse_list_cursor(cls, cursor):
+        """
+        解析get_list_cursor生成的游标
+        :return: (article_order, pub_time, id),游标无效时抛出ValueError
+        """
+        article_order, microseconds, pk = map(int, cursor.split('_'))
+        # 超出范围的数字会在计算时间或查询数据库时抛出OverflowError
+        if not all(-2 ** 63 <= value < 2 ** 63 for value in (article_order, microseconds, pk)):
+            raise ValueError('cursor out of range')
+        try:
+            pub_time = cls.EPOCH + timedelta(microseconds=microseconds)
+        except OverflowError:
+            raise ValueError('cursor out of range')
+        return article_order, pub_time, pk
 
     def get_absolute_url(self):
         return reverse('blog:detailbyid', kwargs={
@@ -124,46 +231,86 @@ class Article(BaseModel):
             'day': self.creation_time.day
         })
 
-    @cache_decorator(60 * 60 * 10)
     def get_category_tree(self):
-        tree = self.category.get_category_tree()
+        tree = CategoryTree.get().get_ancestors(self.category_id)
         names = list(map(lambda c: (c.name, c.get_absolute_url()), tree))
 
         return names
 
+    def render_body(self):
+        """
+        根据body的sha256判断是否需要重新渲染markdown
+        :return: 是否重新渲染
+        """
+        body_hash = get_sha256(self.body)
+        if body_hash == self.body_hash:
+            return False
+        self.body_html, self.body_toc = CommonMarkdown.get_markdown_with_toc(
+            self.body, use_cache=False)
+        self.body_excerpt = Truncator(
+            html.unescape(strip_tags(self.body_html))).chars(self.EXCERPT_LENGTH)
+        self.body_hash = body_hash
+        return True
+
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(update_fields) == {'views'}:
+            return super().save(*args, **kwargs)
+        # 修改时间用于页面缓存的Last-Modified/ETag
+        self.last_modify_time = now()
+        changed_fields = {'last_modify_time'}
+        if update_fields is None or 'body' in update_fields:
+            if self.render_body():
+                changed_fields.update(self.RENDERED_BODY_FIELDS)
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | changed_fields
         super().save(*args, **kwargs)
 
     def viewed(self):
-        self.views += 1
-        self.save(update_fields=['views'])
+        from blog.counters import article_view_counter
+        # 阅读数由计数器缓冲后批量写入,这里加上尚未写入的部分用于展示
+        self.views += article_view_counter.incr(self.id)
 
     def comment_list(self):
-        cache_key = 'article_comments_{id}'.format(id=self.id)
+        '''
+        文章所有已启用的评论,按id倒序
+        评论一次性加载并在内存中组装为评论树,见comments.utils.build_comment_tree
+        '''
+        cache_key = make_tagged_cache_key(
+            'article_comments_{id}'.format(id=self.id), [cache_tag('comments', self.id)])
         value = cache.get(cache_key)
-        if value:
+        if value is not None:
             logger.info('get article comments:{id}'.format(id=self.id))
             return value
         else:
-            comments = self.comment_set.filter(is_enable=True).order_by('-id')
+            from comments.utils import build_comment_tree
+            comments = list(self.comment_set.filter(
+                is_enable=True).select_related('author').order_by('-id'))
+            build_comment_tree(comments)
             cache.set(cache_key, comments, 60 * 100)
             logger.info('set article comments:{id}'.format(id=self.id))
             return comments
 
+    @property
+    def comment_count(self):
+        '''
+        已启用的评论数,for_list()加载的文章直接使用注解,否则查询数据库
+        '''
+        if hasattr(self, 'enabled_comment_count'):
+            return self.enabled_comment_count
+        return self.comment_set.filter(is_enable=True).count()
+
     def get_admin_url(self):
         info = (self._meta.app_label, self._meta.model_name)
         return reverse('admin:%s_%s_change' % info, args=(self.pk,))
 
-    @cache_decorator(expiration=60 * 100)
     def next_article(self):
         # 下一篇
-        return Article.objects.filter(
-            id__gt=self.id, status='p').order_by('id').first()
+        return ArticleSequence.get().get_next(self.id)
 
-    @cache_decorator(expiration=60 * 100)
     def prev_article(self):
         # 前一篇
-        return Article.objects.filter(id__lt=self.id, status='p').first()
+        return ArticleSequence.get().get_prev(self.id)
 
 
 class Category(BaseModel):
@@ -191,43 +338,223 @@ class Category(BaseModel):
     def __str__(self):
         return self.name
 
-    @cache_decorator(60 * 60 * 10)
     def get_category_tree(self):
         """
-        递归获得分类目录的父级
+        获得分类目录及其所有父级,从当前分类到顶级分类
         :return:
         """
-        categorys = []
+        return CategoryTree.get().get_ancestors(self.id)
 
-        def parse(category):
-            categorys.append(category)
-            if category.parent_category:
-                parse(category.parent_category)
-
-        parse(self)
-        return categorys
-
-    @cache_decorator(60 * 60 * 10)
     def get_sub_categorys(self):
         """
-        获得当前分类目录所有子集
+        获得当前分类目录及其所有子集
         :return:
         """
+        return CategoryTree.get().get_descendants(self.id)
+
+
+class ArticleSequence:
+    """
+    已发布文章按id排序的id序列,上一篇/下一篇在内存中二分查找后按主键加载.
+    缓存随'article_sequence'标签失效,只在发布、删除或修改状态时变化
+    """
+    CACHE_TIMEOUT = 60 * 60 * 10
+
+    def __init__(self, ids):
+        self.ids = list(ids)
+
+    @classmethod
+    def get(cls):
+        cache_key = make_tagged_cache_key('article_sequence', ['article_sequence'])
+        sequence = cache.get(cache_key)
+        if sequence is None:
+            sequence = cls(Article.objects.filter(status='p').order_by('id').values_list('id', flat=True))
+            cache.set(cache_key, sequence, cls.CACHE_TIMEOUT)
+            logger.info('set article sequence cache.key:{key}'.format(key=cache_key))
+        return sequence
+
+    def get_next(self, pk):
+        index = bisect_right(self.ids, pk)
+        return self._load(self.ids[index]) if index < len(self.ids) else None
+
+    def get_prev(self, pk):
+        index = bisect_left(self.ids, pk)
+        return self._load(self.ids[index - 1]) if index > 0 else None
+
+    @staticmethod
+    def _load(pk):
+        article = Article.objects.links().filter(pk=pk).first()
+        if article is None:
+            return None
+        return {'pk': article.pk, 'title': article.title, 'url': article.get_absolute_url()}
+
+
+class ArchiveIndex:
+    """
+    文章归档索引: (年, 月) -> 该月发布的文章(id, 标题, url, 发布日期),按发布时间倒序
+    归档页和侧边栏共用,只从values_list构建一次,之后文章保存或删除时增量更新
+    """
+    CACHE_KEY = 'archive_index'
+    CACHE_TIMEOUT = 60 * 60 * 24
+
+    def __init__(self, rows):
+        self.months = {}
+        self.positions = {}
+        for pk, title, pub_time, creation_time in rows:
+            self._append(pk, title, pub_time, creation_time)
+        for entries in self.months.values():
+            self._sort(entries)
+
+    @classmethod
+    def get_cache_key(cls):
+        # 更新时拿不到锁的一方使'archive'标签失效,持有锁的一方写回的旧索引不会再被读到
+        return make_tagged_cache_key(cls.CACHE_KEY, ['archive'])
+
+    @classmethod
+    def get(cls):
+        cache_key = cls.get_cache_key()
+        index = cache.get(cache_key)
+        if index is None:
+            index = cls(Article.objects.filter(status='p').values_list(
+                'id', 'title', 'pub_time', 'creation_time').order_by())
+            cache.set(cache_key, index, cls.CACHE_TIMEOUT)
+            logger.info('set archive index cache.key:{key}'.format(key=cache_key))
+        return index
+
+    @classmethod
+    def update(cls, article, deleted=False):
+        """
+        文章保存或删除后更新缓存中的索引,索引不在缓存中时下次读取再构建.
+        在保存文章的请求中调用,不等待锁
+        """
+        with cache_lock(cls.CACHE_KEY, wait=0) as acquired:
+            if not acquired:
+                # 其他进程正在更新,使索引失效,下次读取时重新构建
+                invalidate_cache_tags('archive')
+                return
+            cache_key = cls.get_cache_key()
+            index = cache.get(cache_key)
+            if index is None:
+                return
+            index.remove(article.pk)
+            if not deleted and article.status == 'p':
+                index.add(article.pk, article.title, article.pub_time, article.creation_time)
+            cache.set(cache_key, index, cls.CACHE_TIMEOUT)
+
+    def add(self, pk, title, pub_time, creation_time):
+        self._sort(self._append(pk, title, pub_time, creation_time))
+
+    def _append(self, pk, title, pub_time, creation_time):
+        pub_time = localtime(pub_time) if is_aware(pub_time) else pub_time
+        month = (pub_time.year, pub_time.month)
+        entry = {
+            'pk': pk,
+            'title': title,
+            'url': Article(id=pk, creation_time=creation_time).get_absolute_url(),
+            'pub_date': pub_time.date(),
+            'pub_time': pub_time,
+        }
+        entries = self.months.setdefault(month, [])
+        entries.append(entry)
+        self.positions[pk] = month
+        return entries
+
+    @staticmethod
+    def _sort(entries):
+        entries.sort(key=lambda e: (e['pub_time'], e['pk']), reverse=True)
+
+    def remove(self, pk):
+        month = self.positions.pop(pk, None)
+        if month is None:
+            return
+        entries = [e for e in self.months[month] if e['pk'] != pk]
+        if entries:
+            self.months[month] = entries
+        else:
+            del self.months[month]
+
+    def get_months(self):
+        """有文章的月份,每月1日,倒序"""
+        return [date(year, month, 1) for year, month in sorted(self.months, reverse=True)]
+
+    def get_years(self):
+        """
+        :return: [(年, [(月, 文章列表)])],均为倒序
+        """
+        years = OrderedDict()
+        for year, month in sorted(self.months, reverse=True):
+            years.setdefault(year, []).append((month, self.months[(year, month)]))
+        return list(years.items())
+
+
+class CategoryTree:
+    """
+    分类目录树
+    一次查询加载所有分类,在内存中计算父级和子集,缓存随'category'标签失效
+    """
+    CACHE_TIMEOUT = 60 * 60 * 10
+
+    def __init__(self, categorys):
+        self.categorys = OrderedDict((c.id, c) for c in categorys)
+        self.children = {pk: [] for pk in self.categorys}
+        self.slugs = {}
+        self.names = {}
+        for c in self.categorys.values():
+            if c.parent_category_id in self.children:
+                self.children[c.parent_category_id].append(c.id)
+                # 父级已在内存中,访问parent_category时不再查询
+                c.parent_category = self.categorys[c.parent_category_id]
+            self.slugs.setdefault(c.slug, c.id)
+            self.names[c.name] = c.id
+
+    @classmethod
+    def get(cls):
+        cache_key = make_tagged_cache_key('category_tree', ['category'])
+        tree = cache.get(cache_key)
+        if tree is None:
+            tree = cls(Category.objects.all())
+            cache.set(cache_key, tree, cls.CACHE_TIMEOUT)
+            logger.info('set category tree cache.key:{key}'.format(key=cache_key))
+        return tree
+
+    def get_by_slug(self, slug):
+        pk = self.slugs.get(slug)
+        return self.categorys[pk] if pk is not None else None
+
+    def get_by_name(self, name):
+        pk = self.names.get(name)
+        return self.categorys[pk] if pk is not None else None
+
+    def get_roots(self):
+        return [c for c in self.categorys.values() if c.parent_category_id not in self.categorys]
+
+    def get_children(self, pk):
+        return [self.categorys[child] for child in self.children.get(pk, [])]
+
+    def get_ancestors(self, pk):
+        """当前分类及其所有父级,从当前分类到顶级分类"""
         categorys = []
-        all_categorys = Category.objects.all()
-
-        def parse(category):
-            if category not in categorys:
-                categorys.append(category)
-            childs = all_categorys.filter(parent_category=category)
-            for child in childs:
-                if category not in categorys:
-                    categorys.append(child)
-                parse(child)
-
-        parse(self)
+        while pk in self.categorys and self.categorys[pk] not in categorys:
+            categorys.append(self.categorys[pk])
+            pk = self.categorys[pk].parent_category_id
         return categorys
 
+    def get_descendant_ids(self, pk):
+        """当前分类及其所有子集的id"""
+        if pk not in self.categorys:
+            return []
+        ids = [pk]
+        seen = {pk}
+        for current in ids:
+            for child in self.children[current]:
+                if child not in seen:
+                    seen.add(child)
+                    ids.append(child)
+        return ids
+
+    def get_descendants(self, pk):
+        return [self.categorys[i] for i in self.get_descendant_ids(pk)]
+
 
 class Tag(BaseModel):
     """文章标签"""
@@ -240,6 +567,7 @@ class Tag(BaseModel):
     def get_absolute_url(self):
         return reverse('blog:tag_detail', kwargs={'tag_name': self.slug})
 
+    # 文章的标签变化时由信号调用 Tag.get_article_count.invalidate(tag)
     @cache_decorator(60 * 60 * 10)
     def get_article_count(self):
         return Article.objects.filter(tags__name=self.name).distinct().count()
@@ -278,7 +606,6 @@ class Links(models.Model):
 
 class SideBar(models.Model):
     """侧边栏,可以展示一些html内容"""
-    """存在BUG：当已存在的侧边栏被修改时，并且当前侧边栏存在于cache当中，那么这个修改不会立即生效"""
     name = models.CharField(_('title'), max_length=100)
     # content = models.TextField(_('content'))
     content = MDTextField(_('content'))
@@ -296,12 +623,6 @@ class SideBar(models.Model):
     def __str__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        from djangoblog.utils import cache
-        # 每次保存新的侧边栏数据时清除cache，让其重新从数据库加载最新数据
-        cache.clear()
-
 
 class BlogSettings(models.Model):
     """blog的配置"""
@@ -372,4 +693,5 @@ class BlogSettings(models.Model):
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         from djangoblog.utils import cache
-        cache.clear()
+        # 依赖配置的其他缓存通过blog_setting标签失效
+        cache.delete('get_blog_setting')
@@ -5,17 +5,19 @@ import urllib
 
 from django import template
 from django.conf import settings
-from django.db.models import Q
+from django.db.models import Count, Q
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import stringfilter
 from django.templatetags.static import static
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 
-from blog.models import Article, Category, Tag, Links, SideBar, LinkShowType
+from blog.counters import article_view_counter
+from blog.models import Article, CategoryTree, Tag, Links, SideBar, LinkShowType
 from comments.models import Comment
-from djangoblog.utils import CommonMarkdown, sanitize_html
-from djangoblog.utils import cache
+from djangoblog.utils import CommonMarkdown
+from djangoblog.utils import cache, get_or_set_cache, make_tagged_cache_key
 from djangoblog.utils import get_current_site
 from oauth.models import OAuthUser
 
@@ -103,8 +105,7 @@ def comment_markdown(content):
     返回:
     转换后的HTML字符串，被标记为安全的。
     """
-    content = CommonMarkdown.get_markdown(content)
-    return mark_safe(sanitize_html(content))
+    return mark_safe(CommonMarkdown.get_markdown(content, sanitize=True))
 
 # 注册一个过滤器，用于截断文章内容的字符数
 @register.filter(is_safe=True)
@@ -178,10 +179,11 @@ def load_articletags(article):
     包含文章标签列表的数据字典。
     """
     tags = article.tags.all()
+    counts = {t['id']: count for t, count, size in get_tag_cloud()}
     tags_list = []
     for tag in tags:
         url = tag.get_absolute_url()
-        count = tag.get_article_count()
+        count = counts.get(tag.id, 0)
         tags_list.append((
             url, count, tag, random.choice(settings.BOOTSTRAP_COLOR_TYPES)
         ))
@@ -190,6 +192,53 @@ def load_articletags(article):
     }
 
 
+def get_tag_cloud():
+    """
+    标签云,一次聚合查询获得所有标签已发布文章的数量并计算字体大小,
+    结果缓存,文章发布或修改标签时失效
+    :return: [(标签, 文章数, 字体大小)]
+    """
+    cache_key = make_tagged_cache_key('tag_cloud', ['tag_cloud'])
+    value = cache.get(cache_key)
+    if value is not None:
+        return value
+    tags = list(Tag.objects.annotate(
+        article_count=Count('article', filter=Q(article__status='p'), distinct=True)).only(
+        'id', 'name', 'slug'))
+    # 根据总数计算出平均值 大小为 (数目/平均值)*步长
+    increment = 5
+    count = sum(t.article_count for t in tags)
+    dd = 1 if (count == 0 or not len(tags)) else count / len(tags)
+    value = [
+        ({'id': t.id, 'name': t.name, 'url': t.get_absolute_url()},
+         t.article_count, (t.article_count / dd) * increment + 10)
+        for t in tags if t.article_count]
+    random.shuffle(value)
+    cache.set(cache_key, value, 60 * 60 * 10)
+    logger.info('set tag cloud cache.key:{key}'.format(key=cache_key))
+    return value
+
+
+def _article_to_dict(article):
+    """侧边栏只缓存文章的标题、链接和阅读数"""
+    return {
+        'id': article.id,
+        'title': article.title,
+        'url': article.get_absolute_url(),
+        'views': article.views
+    }
+
+
+def _apply_pending_views(articles):
+    """加上计数器中尚未写入数据库的阅读数,并重新排序"""
+    pending = article_view_counter.get_pending([a['id'] for a in articles])
+    if not pending:
+        return articles
+    for a in articles:
+        a['views'] += pending.get(a['id'], 0)
+    return sorted(articles, key=lambda a: a['views'], reverse=True)
+
+
 # 加载侧边栏信息，缓存结果以提高性能
 @register.inclusion_tag('blog/tags/sidebar.html')
 def load_sidebar(user, linktype):
@@ -207,45 +256,41 @@ def load_sidebar(user, linktype):
     加载侧边栏
     :return:
     """
-    value = cache.get("sidebar" + linktype)
-    if value:
-        value['user'] = user
-        return value
-    else:
+    cache_key = make_tagged_cache_key("sidebar" + linktype, ['sidebar', 'blog_setting'])
+
+    def compute():
         logger.info('load sidebar')
         from djangoblog.utils import get_blog_setting
         blogsetting = get_blog_setting()
-        recent_articles = Article.objects.filter(
-            status='p')[:blogsetting.sidebar_article_count]
-        sidebar_categorys = Category.objects.all()
-        extra_sidebars = SideBar.objects.filter(
-            is_enable=True).order_by('sequence')
-        most_read_articles = Article.objects.filter(status='p').order_by(
-            '-views')[:blogsetting.sidebar_article_count]
-        dates = Article.objects.datetimes('creation_time', 'month', order='DESC')
-        links = Links.objects.filter(is_enable=True).filter(
-            Q(show_type=str(linktype)) | Q(show_type=LinkShowType.A))
-        commment_list = Comment.objects.filter(is_enable=True).order_by(
-            '-id')[:blogsetting.sidebar_comment_count]
-        # 标签云 计算字体大小
-        # 根据总数计算出平均值 大小为 (数目/平均值)*步长
-        increment = 5
-        tags = Tag.objects.all()
-        sidebar_tags = None
-        if tags and len(tags) > 0:
-            s = [t for t in [(t, t.get_article_count()) for t in tags] if t[1]]
-            count = sum([t[1] for t in s])
-            dd = 1 if (count == 0 or not len(tags)) else count / len(tags)
-            import random
-            sidebar_tags = list(
-                map(lambda x: (x[0], x[1], (x[1] / dd) * increment + 10), s))
-            random.shuffle(sidebar_tags)
-
-        value = {
+        recent_articles = [
+            _article_to_dict(a) for a in Article.objects.filter(
+                status='p').links('views')[:blogsetting.sidebar_article_count]]
+        sidebar_categorys = [
+            {'name': c.name, 'url': c.get_absolute_url()}
+            for c in CategoryTree.get().categorys.values()]
+        extra_sidebars = list(SideBar.objects.filter(
+            is_enable=True).order_by('sequence').values('name', 'content'))
+        most_read_articles = [
+            _article_to_dict(a) for a in Article.objects.filter(status='p').order_by(
+                '-views').links('views')[:blogsetting.sidebar_article_count]]
+        links = list(Links.objects.filter(is_enable=True).filter(
+            Q(show_type=str(linktype)) | Q(show_type=LinkShowType.A)).values('name', 'link'))
+        commment_list = [
+            {
+                'pk': c.pk,
+                'username': c.author.username,
+                'article_title': c.article.title,
+                'article_url': c.article.get_absolute_url()
+            } for c in Comment.objects.filter(is_enable=True).select_related(
+                'author', 'article').only(
+                'id', 'author__username', 'article__id', 'article__title',
+                'article__creation_time').order_by('-id')[:blogsetting.sidebar_comment_count]]
+        sidebar_tags = get_tag_cloud()
+
+        return {
             'recent_articles': recent_articles,
             'sidebar_categorys': sidebar_categorys,
             'most_read_articles': most_read_articles,
-            'article_dates': dates,
             'sidebar_comments': commment_list,
             'sidabar_links': links,
             'show_google_adsense': blogsetting.show_google_adsense,
@@ -255,10 +300,13 @@ def load_sidebar(user, linktype):
             'sidebar_tags': sidebar_tags,
             'extra_sidebars': extra_sidebars
         }
-        cache.set("sidebar" + linktype, value, 60 * 60 * 60 * 3)
-        logger.info('set sidebar cache.key:{key}'.format(key="sidebar" + linktype))
-        value['user'] = user
-        return value
+
+    value = get_or_set_cache(
+        cache_key, compute, 60 * 60 * 60 * 3, soft_expiration=60 * 60 * 60 * 2, single_flight=True)
+    value['most_read_articles'] = _apply_pending_views(value['most_read_articles'])
+    value['user'] = user
+    return value
+
 
 # 加载文章的元信息，如标题、作者等
 @register.inclusion_tag('blog/tags/article_meta_info.html')
@@ -297,63 +345,37 @@ def load_pagination_info(page_obj, page_type, tag_name):
     """
     previous_url = ''
     next_url = ''
+    url_name = None
+    url_kwargs = {}
     if page_type == '':
-        if page_obj.has_next():
-            next_number = page_obj.next_page_number()
-            next_url = reverse('blog:index_page', kwargs={'page': next_number})
-        if page_obj.has_previous():
-            previous_number = page_obj.previous_page_number()
-            previous_url = reverse(
-                'blog:index_page', kwargs={
-                    'page': previous_number})
+        url_name = 'blog:index_page'
     if page_type == '分类标签归档':
         tag = get_object_or_404(Tag, name=tag_name)
-        if page_obj.has_next():
-            next_number = page_obj.next_page_number()
-            next_url = reverse(
-                'blog:tag_detail_page',
-                kwargs={
-                    'page': next_number,
-                    'tag_name': tag.slug})
-        if page_obj.has_previous():
-            previous_number = page_obj.previous_page_number()
-            previous_url = reverse(
-                'blog:tag_detail_page',
-                kwargs={
-                    'page': previous_number,
-                    'tag_name': tag.slug})
+        url_name = 'blog:tag_detail_page'
+        url_kwargs = {'tag_name': tag.slug}
     if page_type == '作者文章归档':
-        if page_obj.has_next():
-            next_number = page_obj.next_page_number()
-            next_url = reverse(
-                'blog:author_detail_page',
-                kwargs={
-                    'page': next_number,
-                    'author_name': tag_name})
-        if page_obj.has_previous():
-            previous_number = page_obj.previous_page_number()
-            previous_url = reverse(
-                'blog:author_detail_page',
-                kwargs={
-                    'page': previous_number,
-                    'author_name': tag_name})
-
+        url_name = 'blog:author_detail_page'
+        url_kwargs = {'author_name': tag_name}
     if page_type == '分类目录归档':
-        category = get_object_or_404(Category, name=tag_name)
-        if page_obj.has_next():
-            next_number = page_obj.next_page_number()
-            next_url = reverse(
-                'blog:category_detail_page',
-                kwargs={
-                    'page': next_number,
-                    'category_name': category.slug})
-        if page_obj.has_previous():
-            previous_number = page_obj.previous_page_number()
-            previous_url = reverse(
-                'blog:category_detail_page',
-                kwargs={
-                    'page': previous_number,
-                    'category_name': category.slug})
+        category = CategoryTree.get().get_by_name(tag_name)
+        if category is None:
+            raise Http404
+        url_name = 'blog:category_detail_page'
+        url_kwargs = {'category_name': category.slug}
+
+    def get_page_url(number, cursor_name, article):
+        url = reverse(url_name, kwargs=dict(url_kwargs, page=number))
+        # 较深的页使用游标分页,避免数据库OFFSET扫描
+        if number > settings.PAGINATE_BY_CURSOR_AFTER:
+            url += '?' + urllib.parse.urlencode({cursor_name: article.get_list_cursor()})
+        return url
+
+    if url_name:
+        articles = list(page_obj.object_list)
+        if page_obj.has_next() and articles:
+            next_url = get_page_url(page_obj.next_page_number(), 'cursor', articles[-1])
+        if page_obj.has_previous() and articles:
+            previous_url = get_page_url(page_obj.previous_page_number(), 'before', articles[0])
 
     return {
         'previous_url': previous_url,
@@ -12,11 +12,61 @@ from django.utils import timezone
 from accounts.models import BlogUser
 from blog.forms import BlogSearchForm
 from blog.models import Article, Category, Tag, SideBar, Links
-from blog.templatetags.blog_tags import load_pagination_info, load_articletags
+from blog.templatetags.blog_tags import load_pagination_info, load_articletags, get_tag_cloud
 from djangoblog.utils import get_current_site, get_sha256
 from oauth.models import OAuthUser, OAuthConfig
 
 
+# 访问量大的表,执行计划中不允许全表扫描或排序
+HOT_TABLES = ['blog_article', 'comments_comment', 'owntracks_owntracklog']
+
+
+def get_query_plan_problems(sql, tables=HOT_TABLES):
+    """
+    EXPLAIN查询,返回执行计划中的全表扫描和排序
+    sqlite: SCAN table(未使用索引) / USE TEMP B-TREE FOR ORDER BY
+    mysql: type=ALL / Using filesort
+    按主键倒序取前几条的扫描可以提前结束,不算全表扫描;
+    排序只检查带LIMIT的查询,按主键取单行的查询不检查
+    """
+    from django.db import connection
+    plain = sql.replace('"', '').replace('`', '')
+    if not sql.startswith('SELECT'):
+        return []
+    limited = ' LIMIT ' in sql
+    table = plain.split(' FROM ')[1].split()[0]
+    problems = []
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            details = [row[-1] for row in cursor.fetchall()]
+            if any(d.startswith('SEARCH %s ' % table) and '(rowid=?)' in d for d in details):
+                limited = False
+            for detail in details:
+                words = detail.split()
+                if words[0] != 'SCAN' or words[1] not in tables or 'INDEX' in detail:
+                    continue
+                if limited and 'ORDER BY %s.id ' % words[1] in plain + ' ' \
+                        and 'USE TEMP B-TREE FOR ORDER BY' not in details:
+                    continue
+                problems.append(detail)
+            if limited and table in tables and 'USE TEMP B-TREE FOR ORDER BY' in details:
+                problems.append('USE TEMP B-TREE FOR ORDER BY')
+        else:
+            cursor.execute('EXPLAIN ' + sql)
+            columns = [c[0].lower() for c in cursor.description]
+            for row in cursor.fetchall():
+                row = dict(zip(columns, row))
+                if row['table'] not in tables:
+                    continue
+                if row['type'] == 'ALL':
+                    problems.append('%s: type=ALL' % row['table'])
+                if limited and 'Using filesort' in (row['extra'] or '') \
+                        and row['type'] not in ('system', 'const', 'eq_ref'):
+                    problems.append('%s: Using filesort' % row['table'])
+    return problems
+
+
 # Create your tests here.
 
 class ArticleTest(TestCase):
@@ -186,6 +236,617 @@ class ArticleTest(TestCase):
         rsp = self.client.get('/eee')
         self.assertEqual(rsp.status_code, 404)
 
+    def test_server_timing(self):
+        from djangoblog.utils import cache
+        cache.clear()
+        rsp = self.client.get('/')
+        self.assertEqual(rsp.status_code, 200)
+        timings = dict(t.split(';dur=') for t in rsp['Server-Timing'].split(', '))
+        self.assertIn('db', timings)
+        self.assertIn('cache', timings)
+        self.assertIn('template', timings)
+        self.assertIn('total', timings)
+        self.assertNotContains(rsp, 'LOAD_TIMES')
+
+    def test_article_rendered_body(self):
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category()
+        category.name = "rendercategory"
+        category.save()
+
+        article = Article()
+        article.title = "rendertitle"
+        article.body = "# Title1\n\nrender content"
+        article.author = user
+        article.category = category
+        article.save()
+        self.assertIn('<h1 id="title1">Title1</h1>', article.body_html)
+        self.assertIn('title1', article.body_toc)
+        self.assertEqual(article.body_excerpt, 'Title1\nrender content')
+        self.assertFalse(article.render_body())
+
+        article.body = "new content"
+        article.save(update_fields=['body'])
+        article = Article.objects.get(pk=article.pk)
+        self.assertEqual(article.body_html, '<p>new content</p>')
+        self.assertEqual(article.body_hash, get_sha256('new content'))
+
+    def test_tag_cloud(self):
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category()
+        category.name = "cloudcategory"
+        category.save()
+        tags = []
+        for i in range(3):
+            tag = Tag()
+            tag.name = "cloudtag" + str(i)
+            tag.save()
+            tags.append(tag)
+        for i in range(3):
+            article = Article()
+            article.title = "cloudtitle" + str(i)
+            article.body = "cloudcontent" + str(i)
+            article.author = user
+            article.category = category
+            article.status = 'p' if i else 'd'
+            article.save()
+            article.tags.add(*tags[:i + 1])
+
+        from djangoblog.utils import cache
+        cache.clear()
+        with self.assertNumQueries(1):
+            cloud = get_tag_cloud()
+        self.assertEqual({t['name']: count for t, count, size in cloud},
+                         {'cloudtag0': 2, 'cloudtag1': 2, 'cloudtag2': 1})
+        with self.assertNumQueries(0):
+            get_tag_cloud()
+
+        article.tags.remove(tags[0])
+        cloud = get_tag_cloud()
+        self.assertEqual({t['name']: count for t, count, size in cloud}['cloudtag0'], 1)
+
+    def test_cursor_pagination(self):
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category()
+        category.name = "cursorcategory"
+        category.save()
+        pub_time = timezone.now()
+        for i in range(25):
+            article = Article()
+            article.title = "cursortitle" + str(i)
+            article.body = "cursorcontent" + str(i)
+            article.author = user
+            article.category = category
+            article.status = 'p'
+            # 部分文章发布时间相同,由id决定顺序
+            article.pub_time = pub_time - timezone.timedelta(days=i // 2)
+            article.article_order = 1 if i == 20 else 0
+            article.save()
+
+        cursor = article.get_list_cursor()
+        self.assertEqual(Article.parse_list_cursor(cursor), (0, article.pub_time, article.id))
+
+        expected = list(Article.objects.filter(type='a', status='p').values_list('title', flat=True))
+        # 登录用户不使用页面缓存,可以检查模板上下文
+        self.client.force_login(user)
+        with self.settings(PAGINATE_BY_CURSOR_AFTER=1):
+            titles = []
+            urls = []
+            url = '/'
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                titles.extend(a.title for a in response.context['article_list'])
+                urls.append(url)
+                url = response.context['next_url']
+            self.assertEqual(titles, expected)
+            self.assertIn('cursor=', urls[-1])
+
+            response = self.client.get(urls[-1])
+            url = response.context['previous_url']
+            self.assertIn('before=', url)
+            response = self.client.get(url)
+            self.assertEqual([a.title for a in response.context['article_list']],
+                             expected[10:20])
+            self.assertEqual(response.context['page_obj'].number, 2)
+
+        response = self.client.get('/page/3/?cursor=bad')
+        self.assertEqual(response.status_code, 404)
+        for cursor in ('0_999999999999999999999_1', '0_1_999999999999999999999', '0_-999999999999999999_1'):
+            self.assertRaises(ValueError, Article.parse_list_cursor, cursor)
+            response = self.client.get('/page/7/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 404)
+
+    def test_cache_decorator_keys(self):
+        from djangoblog.utils import cache, cache_decorator
+        cache.clear()
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category.objects.create(name="keycategory")
+        articles = [Article.objects.create(
+            title="keytitle" + str(i), body="keycontent", author=user, category=category) for i in range(2)]
+        calls = []
+
+        def make_cached():
+            # 每次得到不同的函数对象,模拟另一个进程或重启后的同一个函数
+            @cache_decorator(60)
+            def cached_pk(article):
+                calls.append(article.pk)
+                return article.pk
+
+            return cached_pk
+
+        self.assertEqual(make_cached()(articles[0]), articles[0].pk)
+        self.assertEqual(make_cached()(articles[0]), articles[0].pk)
+        self.assertEqual(make_cached()(articles[1]), articles[1].pk)
+        self.assertEqual(calls, [articles[0].pk, articles[1].pk])
+        make_cached().invalidate(articles[0])
+        self.assertEqual(make_cached()(articles[0]), articles[0].pk)
+        self.assertEqual(len(calls), 3)
+
+        tag = Tag.objects.create(name="keytag")
+        self.assertEqual(tag.get_article_count(), 0)
+        articles[0].tags.add(tag)
+        self.assertEqual(tag.get_article_count(), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(tag.get_article_count(), 1)
+        articles[1].tags.add(tag)
+        self.assertEqual(tag.get_article_count(), 2)
+        articles[1].delete()
+        self.assertEqual(tag.get_article_count(), 1)
+
+    def test_article_navigation(self):
+        from djangoblog.utils import cache
+        cache.clear()
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category.objects.create(name="navcategory")
+        articles = [Article.objects.create(
+            title="navtitle" + str(i), body="navcontent", author=user, category=category,
+            status='d' if i == 1 else 'p') for i in range(3)]
+        first, draft, last = articles
+
+        self.assertEqual(first.next_article(), {'pk': last.pk, 'title': last.title, 'url': last.get_absolute_url()})
+        self.assertIsNone(first.prev_article())
+        # id序列已缓存,只按主键加载相邻的文章
+        with self.assertNumQueries(2):
+            self.assertEqual(last.prev_article()['pk'], first.pk)
+            self.assertIsNone(last.next_article())
+            # 未发布的文章按id位置取相邻的已发布文章
+            self.assertEqual(draft.prev_article()['pk'], first.pk)
+        self.assertEqual(draft.next_article()['pk'], last.pk)
+
+        # 修改正文或标题不重建id序列,标题仍是最新的
+        from blog.models import ArticleSequence
+        sequence = ArticleSequence.get()
+        last.title = "navrenamed"
+        last.body = "navfixed"
+        last.save()
+        from djangoblog.utils import make_tagged_cache_key
+        self.assertEqual(cache.get(make_tagged_cache_key('article_sequence', ['article_sequence'])).ids,
+                         sequence.ids)
+        self.assertEqual(first.next_article()['title'], "navrenamed")
+
+        draft.status = 'p'
+        draft.save()
+        self.assertEqual(first.next_article()['pk'], draft.pk)
+        self.assertEqual(last.prev_article()['pk'], draft.pk)
+        draft.delete()
+        self.assertEqual(first.next_article()['pk'], last.pk)
+
+        response = self.client.get(first.get_absolute_url())
+        self.assertContains(response, last.get_absolute_url())
+
+    def test_archive_index(self):
+        from blog.models import ArchiveIndex
+        from djangoblog.utils import cache
+        cache.clear()
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category.objects.create(name="archivecategory")
+
+        def create(title, pub_time, status='p'):
+            return Article.objects.create(title=title, body="archivecontent", author=user,
+                                          category=category, status=status, pub_time=pub_time)
+
+        tz = timezone.get_current_timezone()
+        old = create("archiveold", timezone.datetime(2020, 1, 10, tzinfo=tz))
+        new = create("archivenew", timezone.datetime(2020, 3, 5, tzinfo=tz))
+        create("archivedraft", timezone.datetime(2020, 2, 1, tzinfo=tz), status='d')
+
+        index = ArchiveIndex.get()
+        self.assertEqual([(d.year, d.month) for d in index.get_months()], [(2020, 3), (2020, 1)])
+        self.assertEqual([(year, [(month, [a['title'] for a in articles]) for month, articles in months])
+                          for year, months in index.get_years()],
+                         [(2020, [(3, ['archivenew']), (1, ['archiveold'])])])
+        self.assertEqual(index.get_years()[0][1][0][1][0]['url'], new.get_absolute_url())
+
+        # 保存和删除时增量更新,不重新查询
+        old.title = "archiverenamed"
+        old.save()
+        draft = Article.objects.get(title="archivedraft")
+        draft.status = 'p'
+        draft.save()
+        new.delete()
+        with self.assertNumQueries(0):
+            index = ArchiveIndex.get()
+        self.assertEqual([(month, [a['title'] for a in articles]) for month, articles in index.get_years()[0][1]],
+                         [(2, ['archivedraft']), (1, ['archiverenamed'])])
+
+        response = self.client.get(reverse('blog:archives'))
+        self.assertContains(response, old.get_absolute_url())
+        self.assertContains(response, "archiverenamed")
+        self.assertNotContains(response, "archivenew")
+
+        # 其他进程正在更新索引时,保存文章不等待锁,直接使索引失效;
+        # 持有锁的进程随后写回的旧索引不会再被读到
+        import time
+        from djangoblog.utils import cache_lock
+        with cache_lock(ArchiveIndex.CACHE_KEY):
+            holder_key, holder_index = ArchiveIndex.get_cache_key(), ArchiveIndex.get()
+            start = time.time()
+            old.title = "archivecontended"
+            old.save()
+            self.assertLess(time.time() - start, 1)
+            cache.set(holder_key, holder_index, ArchiveIndex.CACHE_TIMEOUT)
+        self.assertIn("archivecontended", [a['title'] for a in ArchiveIndex.get().get_years()[0][1][-1][1]])
+
+    def test_static_sitemap(self):
+        import gzip
+        import tempfile
+        from django.test import override_settings
+        from djangoblog.sitemap import sitemap_generator
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category.objects.create(name="sitemapcategory")
+        articles = [Article.objects.create(title="sitemaptitle" + str(i), body="sitemapcontent",
+                                           author=user, category=category) for i in range(5)]
+
+        def read_shard(pk):
+            path = sitemap_generator.shard_path('blog', pk // 2)
+            if not os.path.exists(path):
+                return None
+            with gzip.open(path) as f:
+                return f.read().decode()
+
+        with tempfile.TemporaryDirectory() as root, override_settings(SITEMAP_ROOT=root, SITEMAP_SHARD_SIZE=2):
+            call_command("build_sitemap")
+            with open(os.path.join(root, 'sitemap.xml')) as f:
+                index = f.read()
+            shards = {article.pk // 2 for article in articles}
+            for shard in shards:
+                self.assertIn('/sitemaps/blog-{0}.xml.gz'.format(shard), index)
+            self.assertIn('/sitemaps/category-', index)
+            self.assertIn('/sitemaps/user-', index)
+            self.assertIn(articles[0].get_absolute_url(), read_shard(articles[0].pk))
+
+            # 保存时只重新生成变化对象所在的分片
+            first, last = articles[0], articles[-1]
+            self.assertNotEqual(first.pk // 2, last.pk // 2)
+            first_path = sitemap_generator.shard_path('blog', first.pk // 2)
+            os.utime(first_path, (0, 0))
+            sitemap_generator.interval = 0
+            try:
+                last.status = 'd'
+                last.save()
+                self.assertEqual(os.path.getmtime(first_path), 0)
+                self.assertNotIn(last.get_absolute_url(), read_shard(last.pk) or '')
+                first_url, first_pk = first.get_absolute_url(), first.pk
+                first.delete()
+                self.assertNotIn(first_url, read_shard(first_pk) or '')
+                self.assertNotEqual(os.path.getmtime(first_path) if os.path.exists(first_path) else None, 0)
+
+                # 修改用户名后作者页面的url随之更新
+                user.username = "sitemapuser"
+                user.save()
+                with gzip.open(sitemap_generator.shard_path('User', user.pk // 2)) as f:
+                    self.assertIn(user.get_absolute_url(), f.read().decode())
+            finally:
+                sitemap_generator.interval = None
+            with open(os.path.join(root, 'sitemap.xml')) as f:
+                index = f.read()
+            for shard in shards:
+                self.assertEqual(os.path.exists(sitemap_generator.shard_path('blog', shard)),
+                                 '/sitemaps/blog-{0}.xml.gz'.format(shard) in index)
+
+    def test_article_projections(self):
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category.objects.create(name="projectioncategory")
+        article = Article.objects.create(
+            title="projectiontitle", body="projection " * 1000, author=user, category=category)
+
+        link = Article.objects.links().get(pk=article.pk)
+        card = Article.objects.cards().get(pk=article.pk)
+        for projected in (link, card):
+            self.assertTrue({'body', 'body_html', 'body_toc'} <= projected.get_deferred_fields())
+        with self.assertNumQueries(0):
+            self.assertEqual(link.get_absolute_url(), article.get_absolute_url())
+            self.assertEqual(card.body_excerpt, article.body_excerpt)
+            self.assertEqual(card.views, article.views)
+
+        response = self.client.get('/sitemap.xml')
+        self.assertContains(response, user.get_absolute_url())
+        self.assertContains(response, article.get_absolute_url())
+
+    def test_category_tree(self):
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        parent = None
+        categorys = []
+        for i in range(3):
+            category = Category()
+            category.name = "treecategory" + str(i)
+            category.parent_category = parent
+            category.save()
+            categorys.append(category)
+            parent = category
+
+        article = Article()
+        article.title = "treetitle"
+        article.body = "treecontent"
+        article.author = user
+        article.category = categorys[2]
+        article.status = 'p'
+        article.save()
+
+        from djangoblog.utils import cache
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual([c.id for c in categorys[0].get_sub_categorys()], [c.id for c in categorys])
+            self.assertEqual([c.id for c in categorys[2].get_category_tree()],
+                             [c.id for c in reversed(categorys)])
+            self.assertEqual(categorys[2].get_category_tree()[1].parent_category.id, categorys[0].id)
+            self.assertEqual([name for name, url in article.get_category_tree()],
+                             [c.name for c in reversed(categorys)])
+
+        response = self.client.get(categorys[0].get_absolute_url())
+        self.assertContains(response, article.title)
+
+        category = Category()
+        category.name = "treecategory3"
+        category.parent_category = categorys[2]
+        category.save()
+        self.assertEqual(len(categorys[0].get_sub_categorys()), 4)
+
+        response = self.client.get('/category/no-such-category.html')
+        self.assertEqual(response.status_code, 404)
+
+    def test_article_view_counter(self):
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category()
+        category.name = "viewcategory"
+        category.save()
+        article = Article()
+        article.title = "viewtitle"
+        article.body = "viewcontent"
+        article.author = user
+        article.category = category
+        article.save()
+
+        from blog.counters import ArticleViewCounter
+        counter = ArticleViewCounter(0)
+        counter.incr(article.id)
+        counter.incr(article.id, 2)
+        self.assertEqual(counter.get_pending([article.id]), {})
+        self.assertEqual(Article.objects.get(pk=article.pk).views, 3)
+
+        response = self.client.get(article.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Article.objects.get(pk=article.pk).views, 4)
+
+    def test_page_cache(self):
+        from djangoblog.utils import get_blog_setting
+        # 第一次读取网站配置时会创建配置并使缓存标签失效
+        get_blog_setting()
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category()
+        category.name = "pagecategory"
+        category.save()
+        article = Article()
+        article.title = "pagetitle"
+        article.body = "pagecontent"
+        article.author = user
+        article.category = category
+        article.status = 'p'
+        article.save()
+
+        for url in ['/', article.get_absolute_url()]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            self.assertTrue(response.has_header('Last-Modified'))
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+            article.title = article.title + url
+            article.save()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            self.assertContains(response, article.title)
+
+        views = Article.objects.get(pk=article.pk).views
+        response = self.client.get(article.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Article.objects.get(pk=article.pk).views, views + 1)
+
+        # 其他用户登录和退出不影响匿名用户的页面缓存
+        user.set_password('liangliangyy')
+        user.save()
+        etag = self.client.get('/')['ETag']
+        self.client.login(username='liangliangyy', password='liangliangyy')
+        self.client.logout()
+        self.assertEqual(self.client.get('/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # 不同查询参数的页面分别缓存,页面中的登录链接带有各自的url
+        for source in ('first', 'second'):
+            response = self.client.get(article.get_absolute_url(), {'utm_source': source})
+            self.assertContains(response, 'utm_source=' + source)
+
+        # 只修改侧边栏等数据时,只带If-Modified-Since的请求也返回新页面
+        import time
+        from unittest.mock import patch
+        response = self.client.get('/')
+        last_modified = response['Last-Modified']
+        self.assertEqual(self.client.get('/', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        Links.objects.create(sequence=1, name="pagelink", link='https://www.lylinux.net/pagelink')
+        with patch('blog.views.time.time', return_value=time.time() + 5):
+            response = self.client.get('/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['Last-Modified'], last_modified)
+
+        # 页面内容不变时Last-Modified保持不变
+        last_modified = response['Last-Modified']
+        with patch('blog.views.time.time', return_value=time.time() + 60 * 60 * 4):
+            response = self.client.get('/')
+        self.assertEqual(response['Last-Modified'], last_modified)
+
+    def test_list_page_queries(self):
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category()
+        category.name = "querycategory"
+        category.save()
+        tag = Tag()
+        tag.name = "querytag"
+        tag.save()
+
+        from comments.models import Comment
+        from djangoblog.utils import cache, get_blog_setting
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        def create_articles(start, count):
+            for i in range(start, start + count):
+                article = Article()
+                article.title = "querytitle" + str(i)
+                article.body = "querycontent" + str(i)
+                article.author = user
+                article.category = category
+                article.status = 'p'
+                article.save()
+                article.tags.add(tag)
+                comment = Comment(body='querycomment', author=user, article=article, is_enable=True)
+                comment.save()
+
+        def count_queries(url):
+            cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(context.captured_queries)
+
+        urls = ['/', category.get_absolute_url(), tag.get_absolute_url(), user.get_absolute_url()]
+        # 两次都有下一页,查询数只与页面结构有关,与文章数量无关
+        cache.clear()
+        get_blog_setting()
+        create_articles(0, settings.PAGINATE_BY + 1)
+        counts = [count_queries(url) for url in urls]
+        create_articles(settings.PAGINATE_BY + 1, settings.PAGINATE_BY)
+        self.assertEqual([count_queries(url) for url in urls], counts)
+
+        article = Article.objects.for_list().get(title='querytitle0')
+        with self.assertNumQueries(0):
+            self.assertEqual(article.comment_count, 1)
+            self.assertEqual(article.author.username, user.username)
+            self.assertEqual(article.category.name, category.name)
+            self.assertEqual([t.name for t in article.tags.all()], [tag.name])
+        # 搜索结果等不经过for_list()的文章查询数据库
+        self.assertEqual(Article.objects.get(title='querytitle0').comment_count, 1)
+
+    def test_query_plans(self):
+        from comments.models import Comment
+        from owntracks.models import OwnTrackLog
+        from djangoblog.utils import cache
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        user = BlogUser.objects.create_superuser(
+            email="liangliangyy1@gmail.com", username="planuser", password="liangliangyy1")
+        parent = Category.objects.create(name="planparent")
+        category = Category.objects.create(name="plancategory", parent_category=parent)
+        tag = Tag.objects.create(name="plantag")
+        for i in range(settings.PAGINATE_BY * 2):
+            article = Article.objects.create(
+                title="plantitle" + str(i), body="plancontent" + str(i),
+                author=user, category=category, status='p')
+            article.tags.add(tag)
+        comment = Comment.objects.create(body="plancomment", author=user, article=article, is_enable=True)
+        Comment.objects.create(
+            body="planreply", author=user, article=article, is_enable=True, parent_comment=comment)
+        OwnTrackLog.objects.create(tid='plan', lat=1.0, lon=2.0)
+
+        anonymous = Client()
+        urls = [(anonymous, url) for url in [
+            '/', '/page/2/', parent.get_absolute_url(), category.get_absolute_url(),
+            tag.get_absolute_url(), user.get_absolute_url(), article.get_absolute_url(),
+            '/archives.html']]
+        self.client.force_login(user)
+        date = timezone.localtime().strftime('%Y-%m-%d')
+        urls += [(self.client, '/owntracks/show_dates'), (self.client, '/owntracks/get_datas?date=' + date)]
+
+        problems = {}
+        for client, url in urls:
+            cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            for query in context.captured_queries:
+                plan = get_query_plan_problems(query['sql'])
+                if plan:
+                    problems[query['sql']] = plan
+        self.maxDiff = None
+        self.assertEqual(problems, {})
+
+        # 发件箱每隔几秒轮询一次到期的待发送邮件
+        from servermanager.outbox import EmailOutbox
+        with CaptureQueriesContext(connection) as context:
+            EmailOutbox(None)._claim()
+        sql = [q['sql'] for q in context.captured_queries if q['sql'].startswith('SELECT')][0]
+        self.assertEqual(get_query_plan_problems(sql, tables=['servermanager_emailsendlog']), [])
+
+        # 没有索引的过滤条件应当被发现
+        with CaptureQueriesContext(connection) as context:
+            Article.objects.filter(body_hash='plan').count()
+        self.assertTrue(get_query_plan_problems(context.captured_queries[0]['sql']))
+
+    def test_elapsed_time_shipper(self):
+        from blog.documents import ElapsedTimeShipper
+        shipper = ElapsedTimeShipper(5, 0, 1.0)
+        self.assertFalse(shipper.record('/', 1, timezone.now(), '', '127.0.0.1'))
+        self.assertEqual(shipper.get_stats(), {'pending': 0, 'shipped': 0, 'dropped': 1, 'failed': 0})
+
+        shipper = ElapsedTimeShipper(5, 10, 0)
+        self.assertFalse(shipper.record('/', 1, timezone.now(), '', '127.0.0.1'))
+        self.assertEqual(shipper.get_stats()['dropped'], 0)
+        self.assertEqual(shipper.flush(), 0)
+
+        # 同一批记录的文档id不能重复,否则后面的记录会覆盖前面的
+        from blog.documents import ElaspedTimeDocumentManager
+        from djangoblog.utils import parse_user_agent
+        log_datetime = timezone.now()
+        docs = [ElaspedTimeDocumentManager.to_doc('/', 1, log_datetime, parse_user_agent(''), '127.0.0.1')
+                for i in range(100)]
+        self.assertEqual(len({doc.meta.id for doc in docs}), 100)
+
     def test_commands(self):
         user = BlogUser.objects.get_or_create(
             email="liangliangyy@gmail.com",
@@ -228,5 +889,7 @@ class ArticleTest(TestCase):
         call_command("ping_baidu", "all")
         call_command("create_testdata")
         call_command("clear_cache")
+        call_command("cache_stats")
+        call_command("benchmark_projections", "--repeat", "1")
         call_command("sync_user_avatar")
         call_command("build_search_words")
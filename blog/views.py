@@ -1,28 +1,108 @@
 import logging
 import os
+import time
 import uuid
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.core.paginator import Paginator
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.db.models import Max, Q
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render
 from django.templatetags.static import static
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag, urlencode
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 from haystack.views import SearchView
 
-from blog.models import Article, Category, LinkShowType, Links, Tag
+from blog.models import ArchiveIndex, Article, CategoryTree, LinkShowType, Links, Tag
 from comments.forms import CommentForm
-from djangoblog.utils import cache, get_blog_setting, get_sha256
+from djangoblog.utils import cache, cache_tag, get_blog_setting, get_cache_tag_versions, get_sha256, \
+    make_tagged_cache_key, request_timing
 
 logger = logging.getLogger(__name__)
 
 
-class ArticleListView(ListView):
+class PageCacheMixin:
+    '''
+    匿名用户的整页缓存
+    根据页面依赖的数据计算ETag/Last-Modified,校验值未变化时直接返回304,
+    否则从缓存中返回渲染好的页面;登录用户不使用缓存
+    '''
+    page_cache_timeout = settings.PAGE_CACHE_TIMEOUT
+    # 所有页面都依赖的缓存标签: 文章,分类(导航),侧边栏,网站配置
+    page_cache_tags = ['article', 'category', 'sidebar', 'blog_setting']
+    # etag第一次出现时间的保存秒数,不短于页面缓存,过期后Last-Modified会后移
+    page_etag_time_timeout = max(settings.PAGE_CACHE_TIMEOUT, 60 * 60 * 24)
+
+    def get_page_validators(self):
+        '''
+        子类重写.获得页面自身的校验值
+        :return: (etag组成部分列表, last_modified时间)
+        '''
+        return [], None
+
+    def get_page_cache_tags(self):
+        return self.page_cache_tags
+
+    def on_page_cache_hit(self):
+        '''
+        子类重写.页面未经过渲染直接从缓存返回(或返回304)时调用
+        '''
+        pass
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+            return super(PageCacheMixin, self).dispatch(request, *args, **kwargs)
+
+        parts, last_modified = self.get_page_validators()
+        versions = get_cache_tag_versions(self.get_page_cache_tags())
+        # 页面中会渲染当前url(如登录链接的next),所以按完整的查询参数区分
+        query = urlencode(sorted((k, v) for k, values in request.GET.lists() for v in values))
+        etag_str = '|'.join(
+            [request.path, request.LANGUAGE_CODE, query] + [str(p) for p in parts] +
+            ['{k}={v}'.format(k=k, v=versions[k]) for k in sorted(versions)])
+        etag = quote_etag(get_sha256(etag_str))
+        # 缓存标签的版本号不是时间,记录每个etag第一次出现的时间并入Last-Modified,
+        # 侧边栏,友情链接,网站配置等变化后只带If-Modified-Since的请求也不会返回304
+        etag_time_key = 'page_etag_time_' + etag.strip('"')
+        etag_time = cache.get(etag_time_key)
+        if etag_time is None:
+            etag_time = int(time.time())
+            cache.add(etag_time_key, etag_time, self.page_etag_time_timeout)
+            etag_time = cache.get(etag_time_key, etag_time)
+        last_modified = max(int(last_modified.timestamp()) if last_modified else 0, etag_time)
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            cache_key = 'page_cache_' + etag.strip('"')
+            response = cache.get(cache_key)
+            if response is None:
+                response = super(PageCacheMixin, self).dispatch(request, *args, **kwargs)
+                if hasattr(response, 'render') and callable(response.render):
+                    with request_timing('template'):
+                        response = response.render()
+                if response.status_code == 200:
+                    cache.set(cache_key, response, self.page_cache_timeout)
+                    logger.info('set page cache.key:{key}'.format(key=cache_key))
+            else:
+                self.on_page_cache_hit()
+        else:
+            self.on_page_cache_hit()
+
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+class ArticleListView(PageCacheMixin, ListView):
     # template_name属性用于指定使用哪个模板进行渲染
     template_name = 'blog/article_index.html'
 
@@ -57,36 +137,137 @@ class ArticleListView(ListView):
         """
         raise NotImplementedError()
 
+    def get_queryset_cache_tags(self):
+        """
+        子类重写.获得queryset缓存依赖的标签,标签失效时缓存随之失效
+        """
+        return ['article']
+
+    def get_page_cache_tags(self):
+        return self.page_cache_tags + self.get_queryset_cache_tags()
+
+    def get_page_validators(self):
+        return [self.page_number], get_article_last_modified()
+
     def get_queryset_from_cache(self, cache_key):
         '''
-        缓存页面数据
+        缓存页面数据,只缓存当前页的文章id列表和文章总数
         :param cache_key: 缓存key
-        :return:
+        :return: {'ids': 当前页文章id, 'count': 文章总数, 'page': 页码}
         '''
+        cursor, reverse = self.get_page_cursor()
+        if cursor:
+            cache_key = '{key}_{direction}_{cursor}'.format(
+                key=cache_key, direction='before' if reverse else 'cursor', cursor=get_sha256(cursor))
+        cache_key = make_tagged_cache_key(cache_key, self.get_queryset_cache_tags())
         value = cache.get(cache_key)
         if value:
             logger.info('get view cache.key:{key}'.format(key=cache_key))
             return value
         else:
-            article_list = self.get_queryset_data()
-            cache.set(cache_key, article_list)
+            value = self.get_page_ids(self.get_queryset_data())
+            cache.set(cache_key, value)
             logger.info('set view cache.key:{key}'.format(key=cache_key))
-            return article_list
+            return value
+
+    def get_page_ids(self, queryset):
+        '''
+        执行查询,获得当前页的文章id
+        :param queryset: 文章queryset
+        :return:
+        '''
+        if not self.paginate_by:
+            ids = list(queryset.values_list('id', flat=True))
+            return {'ids': ids, 'count': len(ids), 'page': 1}
+        cursor, reverse = self.get_page_cursor()
+        if cursor:
+            return self.get_page_ids_by_cursor(queryset, cursor, reverse)
+        paginator, page, object_list, is_paginated = super(
+            ArticleListView, self).paginate_queryset(queryset, self.paginate_by)
+        return {
+            'ids': list(object_list.values_list('id', flat=True)),
+            'count': paginator.count,
+            'page': page.number
+        }
+
+    def get_page_cursor(self):
+        '''
+        获得请求中的分页游标
+        :return: (游标, 是否向前翻页)
+        '''
+        if self.request.GET.get('cursor'):
+            return self.request.GET['cursor'], False
+        if self.request.GET.get('before'):
+            return self.request.GET['before'], True
+        return None, False
+
+    def get_page_ids_by_cursor(self, queryset, cursor, reverse):
+        '''
+        游标分页,根据上一页最后一篇(或下一页第一篇)文章的位置查询当前页,
+        翻到很深的页时不需要OFFSET扫描前面的文章
+        '''
+        try:
+            ids = list(queryset.seek(cursor, reverse).values_list('id', flat=True)[:self.paginate_by])
+        except ValueError:
+            raise Http404
+        if reverse:
+            ids.reverse()
+        count = queryset.count()
+        paginator = self.get_paginator(range(count), self.paginate_by)
+        try:
+            page = min(max(int(self.page_number), 1), paginator.num_pages)
+        except ValueError:
+            raise Http404
+        return {'ids': ids, 'count': count, 'page': page}
 
     def get_queryset(self):
         '''
-        重写默认，从缓存获取数据
+        重写默认，从缓存获取当前页的文章id,再一次性加载文章
         :return:
         '''
         key = self.get_queryset_cache_key()
         value = self.get_queryset_from_cache(key)
-        return value
+        self.article_count = value['count']
+        self.page_index = value['page']
+        articles = Article.objects.for_list().in_bulk(value['ids'])
+        return [articles[pk] for pk in value['ids'] if pk in articles]
+
+    def paginate_queryset(self, queryset, page_size):
+        '''
+        queryset已经是当前页的文章,根据缓存的文章总数构造分页信息
+        '''
+        paginator = self.get_paginator(
+            range(self.article_count),
+            page_size,
+            orphans=self.get_paginate_orphans(),
+            allow_empty_first_page=self.get_allow_empty())
+        page = paginator.page(self.page_index)
+        page.object_list = queryset
+        return (paginator, page, queryset, page.has_other_pages())
 
     def get_context_data(self, **kwargs):
         kwargs['linktype'] = self.link_type
         return super(ArticleListView, self).get_context_data(**kwargs)
 
 
+def get_article_last_modified():
+    '''
+    已发布文章及评论的最后修改时间,用于列表页的Last-Modified
+    '''
+    cache_key = make_tagged_cache_key('article_last_modified', ['article', 'sidebar'])
+    value = cache.get(cache_key)
+    if value is None:
+        from comments.models import Comment
+        times = [
+            Article.objects.filter(status='p').aggregate(
+                last_modify_time=Max('last_modify_time'))['last_modify_time'],
+            Comment.objects.filter(is_enable=True).order_by('-id').values_list(
+                'creation_time', flat=True).first()]
+        value = max(filter(None, times), default=timezone.now())
+        cache.set(cache_key, value)
+    return value
+
+
 class IndexView(ArticleListView):
     '''
     首页
@@ -103,7 +284,7 @@ class IndexView(ArticleListView):
         return cache_key
 
 
-class ArticleDetailView(DetailView):
+class ArticleDetailView(PageCacheMixin, DetailView):
     '''
     文章详情页面
     '''
@@ -112,17 +293,34 @@ class ArticleDetailView(DetailView):
     pk_url_kwarg = 'article_id'
     context_object_name = "article"
 
+    def get_queryset(self):
+        return Article.objects.for_list()
+
     def get_object(self, queryset=None):
         obj = super(ArticleDetailView, self).get_object()
         obj.viewed()
         self.object = obj
         return obj
 
+    def get_page_validators(self):
+        article = Article.objects.filter(pk=self.kwargs[self.pk_url_kwarg]).annotate(
+            latest_comment_id=Max('comment__id', filter=Q(comment__is_enable=True)),
+            latest_comment_time=Max('comment__creation_time', filter=Q(comment__is_enable=True))).values(
+            'last_modify_time', 'latest_comment_id', 'latest_comment_time').first()
+        if not article:
+            return [], None
+        last_modified = max(filter(None, [article['last_modify_time'], article['latest_comment_time']]))
+        return [article['last_modify_time'].isoformat(), article['latest_comment_id']], last_modified
+
+    def on_page_cache_hit(self):
+        from blog.counters import article_view_counter
+        article_view_counter.incr(int(self.kwargs[self.pk_url_kwarg]))
+
     def get_context_data(self, **kwargs):
         comment_form = CommentForm()
 
         article_comments = self.object.comment_list()
-        parent_comments = article_comments.filter(parent_comment=None)
+        parent_comments = [c for c in article_comments if c.parent_comment_id is None]
         blog_setting = get_blog_setting()
         paginator = Paginator(parent_comments, blog_setting.article_comment_count)
         page = self.request.GET.get('comment_page', '1')
@@ -148,8 +346,7 @@ class ArticleDetailView(DetailView):
         kwargs['form'] = comment_form
         kwargs['article_comments'] = article_comments
         kwargs['p_comments'] = p_comments
-        kwargs['comment_count'] = len(
-            article_comments) if article_comments else 0
+        kwargs['comment_count'] = len(article_comments)
 
         kwargs['next_article'] = self.object.next_article
         kwargs['prev_article'] = self.object.prev_article
@@ -163,27 +360,29 @@ class CategoryDetailView(ArticleListView):
     '''
     page_type = "分类目录归档"
 
-    def get_queryset_data(self):
-        slug = self.kwargs['category_name']
-        category = get_object_or_404(Category, slug=slug)
+    def get_category(self):
+        if not hasattr(self, 'category'):
+            self.category = CategoryTree.get().get_by_slug(self.kwargs['category_name'])
+            if self.category is None:
+                raise Http404
+            self.categoryname = self.category.name
+        return self.category
 
-        categoryname = category.name
-        self.categoryname = categoryname
-        categorynames = list(
-            map(lambda c: c.name, category.get_sub_categorys()))
+    def get_queryset_data(self):
+        category_ids = CategoryTree.get().get_descendant_ids(self.get_category().id)
         article_list = Article.objects.filter(
-            category__name__in=categorynames, status='p')
+            category_id__in=category_ids, status='p')
         return article_list
 
     def get_queryset_cache_key(self):
-        slug = self.kwargs['category_name']
-        category = get_object_or_404(Category, slug=slug)
-        categoryname = category.name
-        self.categoryname = categoryname
-        cache_key = 'category_list_{categoryname}_{page}'.format(
-            categoryname=categoryname, page=self.page_number)
+        cache_key = 'category_list_{id}_{page}'.format(
+            id=self.get_category().id, page=self.page_number)
         return cache_key
 
+    def get_queryset_cache_tags(self):
+        category_ids = CategoryTree.get().get_descendant_ids(self.get_category().id)
+        return ['category'] + [cache_tag('category', pk) for pk in category_ids]
+
     def get_context_data(self, **kwargs):
 
         categoryname = self.categoryname
@@ -209,6 +408,11 @@ class AuthorDetailView(ArticleListView):
             author_name=author_name, page=self.page_number)
         return cache_key
 
+    def get_queryset_cache_tags(self):
+        author_id = get_user_model().objects.filter(
+            username=self.kwargs['author_name']).values_list('id', flat=True).first()
+        return [cache_tag('author', author_id)]
+
     def get_queryset_data(self):
         author_name = self.kwargs['author_name']
         article_list = Article.objects.filter(
@@ -246,6 +450,11 @@ class TagDetailView(ArticleListView):
             tag_name=tag_name, page=self.page_number)
         return cache_key
 
+    def get_queryset_cache_tags(self):
+        slug = self.kwargs['tag_name']
+        tag = get_object_or_404(Tag, slug=slug)
+        return [cache_tag('tag', tag.id)]
+
     def get_context_data(self, **kwargs):
         # tag_name = self.kwargs['tag_name']
         tag_name = self.name
@@ -263,12 +472,13 @@ class ArchivesView(ArticleListView):
     page_kwarg = None
     template_name = 'blog/article_archives.html'
 
-    def get_queryset_data(self):
-        return Article.objects.filter(status='p').all()
+    def get_queryset(self):
+        # 归档索引只包含标题和url,不加载文章正文
+        return []
 
-    def get_queryset_cache_key(self):
-        cache_key = 'archives'
-        return cache_key
+    def get_context_data(self, **kwargs):
+        kwargs['archive_years'] = ArchiveIndex.get().get_years()
+        return super(ArchivesView, self).get_context_data(**kwargs)
 
 
 class LinkListView(ListView):
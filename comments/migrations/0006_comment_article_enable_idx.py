@@ -0,0 +1,17 @@
+# Generated by Django 4.2.14 on 2026-10-17 04:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0005_alter_comment_body'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['article', 'is_enable', 'id'], name='comments_article_enable_idx'),
+        ),
+    ]
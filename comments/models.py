@@ -34,6 +34,10 @@ class Comment(models.Model):
         verbose_name = _('comment')
         verbose_name_plural = verbose_name
         get_latest_by = 'id'
+        indexes = [
+            # 文章评论列表
+            models.Index(fields=['article', 'is_enable', 'id'], name='comments_article_enable_idx'),
+        ]
 
     def __str__(self):
         return self.body
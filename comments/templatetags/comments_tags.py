@@ -1,5 +1,7 @@
 from django import template
 
+from comments.utils import build_comment_tree
+
 register = template.Library()
 
 
@@ -8,15 +10,18 @@ def parse_commenttree(commentlist, comment):
     """获得当前评论子评论的列表
         用法: {% parse_commenttree article_comments comment as childcomments %}
     """
+    comments = list(commentlist)
+    if not all(hasattr(c, 'children') for c in comments):
+        build_comment_tree(comments)
+    nodes = {c.id: c for c in comments}
+    if comment.id not in nodes:
+        return []
     datas = []
-
-    def parse(c):
-        childs = commentlist.filter(parent_comment=c, is_enable=True)
-        for child in childs:
-            datas.append(child)
-            parse(child)
-
-    parse(comment)
+    stack = list(reversed(nodes[comment.id].children))
+    while stack:
+        c = stack.pop()
+        datas.append(c)
+        stack.extend(reversed(c.children))
     return datas
 
 
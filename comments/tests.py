@@ -100,6 +100,8 @@ class CommentsTest(TransactionTestCase):
         comment = Comment.objects.get(id=parent_comment_id)
         tree = parse_commenttree(article.comment_list(), comment)
         self.assertEqual(len(tree), 1)
+        self.assertEqual(tree[0].depth, 1)
+        self.assertEqual(tree[0].reply_to.id, parent_comment_id)
         data = show_comment_item(comment, True)
         self.assertIsNotNone(data)
         s = get_max_articleid_commentid()
@@ -107,3 +109,47 @@ class CommentsTest(TransactionTestCase):
 
         from comments.utils import send_comment_email
         send_comment_email(comment)
+
+    def test_comment_tree(self):
+        category = Category()
+        category.name = "categorytree"
+        category.save()
+
+        article = Article()
+        article.title = "nicetitletree"
+        article.body = "nicecontenttree"
+        article.author = self.user
+        article.category = category
+        article.save()
+
+        def create_comment(parent=None, is_enable=True):
+            comment = Comment(body='tree', author=self.user, article=article,
+                              parent_comment=parent, is_enable=is_enable)
+            comment.save()
+            return comment
+
+        root = create_comment()
+        reply = create_comment(root)
+        reply_reply = create_comment(reply)
+        disabled = create_comment(root, is_enable=False)
+        create_comment(disabled)
+        other_root = create_comment()
+
+        from djangoblog.utils import cache
+        cache.clear()
+        article = Article.objects.get(pk=article.pk)
+        with self.assertNumQueries(1):
+            comments = article.comment_list()
+            roots = [c for c in comments if c.parent_comment_id is None]
+            self.assertEqual([c.id for c in roots], [other_root.id, root.id])
+            root_node = roots[1]
+            self.assertEqual([c.id for c in root_node.descendants], [reply.id, reply_reply.id])
+            self.assertEqual([c.depth for c in root_node.descendants], [1, 2])
+            self.assertEqual(root_node.descendants[1].reply_to.author.username, self.user.username)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(article.comment_list()), 5)
+
+        response = self.client.get(article.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'id="comment-{id}"'.format(id=reply_reply.id))
+        self.assertNotContains(response, 'id="comment-{id}"'.format(id=disabled.id))
@@ -8,6 +8,46 @@ from djangoblog.utils import send_email
 logger = logging.getLogger(__name__)
 
 
+def build_comment_tree(comments):
+    '''
+    在内存中组装评论树,避免逐层查询子评论
+    每个评论附加以下属性:
+    depth: 层级,顶级评论为0
+    reply_to: 回复的评论,顶级评论为None
+    children: 直接回复
+    descendants: 按显示顺序展开的所有回复,仅顶级评论有内容
+    :param comments: 文章所有已启用的评论
+    :return: 顶级评论列表,顺序与comments一致
+    '''
+    nodes = {c.id: c for c in comments}
+    roots = []
+    for c in comments:
+        c.depth = 0
+        c.reply_to = None
+        c.children = []
+        c.descendants = []
+    for c in comments:
+        if c.parent_comment_id is None:
+            roots.append(c)
+        elif c.parent_comment_id in nodes:
+            parent = nodes[c.parent_comment_id]
+            c.reply_to = parent
+            # 父评论已在内存中,访问parent_comment时不再查询
+            c.parent_comment = parent
+            parent.children.append(c)
+        # 父评论未启用时,子评论不显示
+
+    for root in roots:
+        # 深度优先展开,使用栈避免评论层级过深时递归溢出
+        stack = [(child, 1) for child in reversed(root.children)]
+        while stack:
+            node, depth = stack.pop()
+            node.depth = depth
+            root.descendants.append(node)
+            stack.extend((child, depth + 1) for child in reversed(node.children))
+    return roots
+
+
 def send_comment_email(comment):
     site = get_current_site().domain
     subject = _('Thanks for your comment')
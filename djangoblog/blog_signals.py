@@ -1,20 +1,24 @@
-import _thread
 import logging
 
 import django.dispatch
 from django.conf import settings
 from django.contrib.admin.models import LogEntry
+from django.contrib.auth import get_user_model
 from django.contrib.auth.signals import user_logged_in, user_logged_out
-from django.core.mail import EmailMultiAlternatives
-from django.db.models.signals import post_save
+from django.contrib.sites.models import Site
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 
+from blog.models import ArchiveIndex, Article, BlogSettings, Category, Links, SideBar, Tag
 from comments.models import Comment
 from comments.utils import send_comment_email
-from djangoblog.spider_notify import SpiderNotify
-from djangoblog.utils import cache, expire_view_cache, delete_sidebar_cache, delete_view_cache
+from djangoblog.sitemap import sitemap_generator
+from djangoblog.spider_notify import spider_notify_queue
+from djangoblog.utils import cache_tag, expire_view_cache, delete_view_cache, \
+    invalidate_cache_tags
 from djangoblog.utils import get_current_site
-from oauth.models import OAuthUser
+from oauth.models import OAuthConfig, OAuthUser
+from oauth.oauthmanager import get_oauth_apps
 
 logger = logging.getLogger(__name__)
 
@@ -31,26 +35,9 @@ def send_email_signal_handler(sender, **kwargs):
     title = kwargs['title']
     content = kwargs['content']
 
-    msg = EmailMultiAlternatives(
-        title,
-        content,
-        from_email=settings.DEFAULT_FROM_EMAIL,
-        to=emailto)
-    msg.content_subtype = "html"
-
-    from servermanager.models import EmailSendLog
-    log = EmailSendLog()
-    log.title = title
-    log.content = content
-    log.emailto = ','.join(emailto)
-
-    try:
-        result = msg.send()
-        log.send_result = result > 0
-    except Exception as e:
-        logger.error(f"失败邮箱号: {emailto}, {e}")
-        log.send_result = False
-    log.save()
+    # 只写入发件箱,由后台线程或 send_emails 命令发送,避免阻塞请求
+    from servermanager.outbox import email_outbox
+    email_outbox.put(emailto, title, content)
 
 
 @receiver(oauth_user_login_signal)
@@ -63,7 +50,89 @@ def oauth_user_login_signal_handler(sender, **kwargs):
         oauthuser.picture = save_user_avatar(oauthuser.picture)
         oauthuser.save()
 
-    delete_sidebar_cache()
+
+def get_instance_cache_tags(instance):
+    """
+    获得model实例变化时需要失效的缓存标签
+    :param instance: model实例
+    :return: 标签集合
+    """
+    tags = set()
+    if isinstance(instance, Article):
+        tags.update([
+            'article',
+            'sidebar',
+            'tag_cloud',
+            cache_tag('article', instance.pk),
+            cache_tag('category', instance.category_id),
+            cache_tag('author', instance.author_id)])
+        if instance.pk:
+            tags.update(cache_tag('tag', pk)
+                        for pk in instance.tags.values_list('id', flat=True))
+        previous = getattr(instance, '_previous_relations', None)
+        if previous:
+            tags.add(cache_tag('category', previous['category_id']))
+            tags.add(cache_tag('author', previous['author_id']))
+        # 上一篇/下一篇的id序列只在发布、删除或修改状态时变化
+        if not previous or previous['status'] != instance.status:
+            tags.add('article_sequence')
+    elif isinstance(instance, Category):
+        tags.update(['category', 'sidebar', cache_tag('category', instance.pk)])
+    elif isinstance(instance, Tag):
+        tags.update(['tag', 'sidebar', 'tag_cloud', cache_tag('tag', instance.pk)])
+    elif isinstance(instance, Comment):
+        tags.update(['sidebar', cache_tag('comments', instance.article_id)])
+    elif isinstance(instance, (SideBar, Links)):
+        tags.add('sidebar')
+    elif isinstance(instance, BlogSettings):
+        tags.add('blog_setting')
+    elif isinstance(instance, get_user_model()):
+        tags.add(cache_tag('author', instance.pk))
+    return tags
+
+
+def invalidate_cached_functions(instance):
+    """
+    删除不依赖缓存标签的函数缓存
+    :param instance: 保存或删除的model实例
+    """
+    if isinstance(instance, Site):
+        get_current_site.invalidate()
+    elif isinstance(instance, OAuthConfig):
+        get_oauth_apps.invalidate()
+
+
+def update_sitemap(instance):
+    """
+    记录需要重新生成的站点地图分片
+    :param instance: 保存或删除的model实例
+    """
+    if isinstance(instance, Article):
+        sitemap_generator.put('blog', instance.pk)
+        sitemap_generator.put('User', instance.author_id)
+        previous = getattr(instance, '_previous_relations', None)
+        if previous:
+            sitemap_generator.put('User', previous['author_id'])
+    elif isinstance(instance, Category):
+        sitemap_generator.put('Category', instance.pk)
+    elif isinstance(instance, Tag):
+        sitemap_generator.put('Tag', instance.pk)
+    elif isinstance(instance, get_user_model()):
+        # 作者页面的url由用户名生成
+        sitemap_generator.put('User', instance.pk)
+
+
+def invalidate_tag_article_counts(tag_ids):
+    for pk in tag_ids:
+        Tag.get_article_count.invalidate(Tag(pk=pk))
+
+
+@receiver(pre_save, sender=Article)
+def article_pre_save_callback(sender, instance, raw, **kwargs):
+    # 记录修改前的分类、作者和状态,以便同时失效旧分类/作者的列表缓存
+    if instance.pk and not raw:
+        instance._previous_relations = Article.objects.filter(
+            pk=instance.pk).values('category_id', 'author_id', 'status').first()
 
 
 @receiver(post_save)
@@ -75,19 +144,19 @@ def model_post_save_callback(
         using,
         update_fields,
         **kwargs):
-    clearcache = False
     if isinstance(instance, LogEntry):
         return
-    if 'get_full_url' in dir(instance):
-        is_update_views = update_fields == {'views'}
+    is_update_views = update_fields == {'views'}
+    # 只推送对外公开的页面,用户等其他模型的修改不推送
+    is_public_page = isinstance(instance, (Category, Tag)) or (
+        isinstance(instance, Article) and instance.status == 'p')
+    if is_public_page:
         if not settings.TESTING and not is_update_views:
             try:
                 notify_url = instance.get_full_url()
-                SpiderNotify.baidu_notify([notify_url])
+                spider_notify_queue.put(notify_url)
             except Exception as ex:
                 logger.error("notify sipder", ex)
-        if not is_update_views:
-            clearcache = True
 
     if isinstance(instance, Comment):
         if instance.is_enable:
@@ -101,24 +170,61 @@ def model_post_save_callback(
                 servername=site,
                 serverport=80,
                 key_prefix='blogdetail')
-            if cache.get('seo_processor'):
-                cache.delete('seo_processor')
-            comment_cache_key = 'article_comments_{id}'.format(
-                id=instance.article.id)
-            cache.delete(comment_cache_key)
-            delete_sidebar_cache()
             delete_view_cache('article_comments', [str(instance.article.pk)])
 
-            _thread.start_new_thread(send_comment_email, (instance,))
-
-    if clearcache:
-        cache.clear()
+            send_comment_email(instance)
+
+    if not is_update_views:
+        tags = get_instance_cache_tags(instance)
+        if tags:
+            invalidate_cache_tags(*tags)
+        invalidate_cached_functions(instance)
+        if isinstance(instance, Article):
+            ArchiveIndex.update(instance)
+        update_sitemap(instance)
+
+
+@receiver(pre_delete)
+def model_pre_delete_callback(sender, instance, using, **kwargs):
+    # 删除后关联关系已不存在,需在删除前计算标签
+    instance._cache_tags = get_instance_cache_tags(instance)
+    if isinstance(instance, Article):
+        instance._cache_tags.add('article_sequence')
+        instance._tag_ids = list(instance.tags.values_list('id', flat=True))
+
+
+@receiver(post_delete)
+def model_post_delete_callback(sender, instance, using, **kwargs):
+    tags = getattr(instance, '_cache_tags', None)
+    if tags:
+        invalidate_cache_tags(*tags)
+    invalidate_tag_article_counts(getattr(instance, '_tag_ids', []))
+    invalidate_cached_functions(instance)
+    if isinstance(instance, Article):
+        ArchiveIndex.update(instance, deleted=True)
+    update_sitemap(instance)
+
+
+@receiver(m2m_changed, sender=Article.tags.through)
+def article_tags_changed_callback(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        tags = {'article', 'sidebar', 'tag_cloud', cache_tag('tag', instance.pk)}
+        tags.update(cache_tag('article', pk) for pk in pk_set or [])
+        invalidate_tag_article_counts([instance.pk])
+    else:
+        tags = get_instance_cache_tags(instance)
+        tags.update(cache_tag('tag', pk) for pk in pk_set or [])
+        # pre_clear时pk_set为空,此时文章的标签还在
+        invalidate_tag_article_counts(
+            pk_set if pk_set is not None else instance.tags.values_list('id', flat=True))
+    invalidate_cache_tags(*tags)
 
 
 @receiver(user_logged_in)
 @receiver(user_logged_out)
 def user_auth_callback(sender, request, user, **kwargs):
     if user and user.username:
+        # 匿名用户的页面和侧边栏不包含用户信息,登录和退出时不需要失效缓存
         logger.info(user)
-        delete_sidebar_cache()
-        # cache.clear()
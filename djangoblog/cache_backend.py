@@ -0,0 +1,277 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+
+from djangoblog.utils import BackgroundFlusher
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LocalTier:
+    """
+    进程内的一级缓存,同一进程内所有线程共用.
+    订阅redis的失效广播,收到其他进程写入的key时删除本地副本;
+    订阅断开期间可能漏掉广播,此时不使用本地缓存
+    """
+
+    def __init__(self, name, client, channel, timeout, max_entries):
+        self.pid = os.getpid()
+        self.node_id = uuid.uuid4().hex
+        self.client = client
+        self.channel = channel
+        self.timeout = timeout
+        self.cache = LocMemCache(name, {'TIMEOUT': timeout, 'OPTIONS': {'MAX_ENTRIES': max_entries}})
+        self.cache.clear()
+        self.ready = False
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._listen, name=name + '-invalidation', daemon=True)
+        self._thread.start()
+
+    def record(self, name, count=1):
+        with self._stats_lock:
+            self.stats[name] += count
+
+    def take_stats(self):
+        """取出并清零自上次以来的计数"""
+        with self._stats_lock:
+            stats, self.stats = self.stats, Counter()
+        return stats
+
+    def get(self, key):
+        if not self.ready:
+            return _MISSING
+        return self.cache.get(key, _MISSING)
+
+    def set(self, key, value, timeout):
+        if not self.ready:
+            return
+        if timeout is not None:
+            if timeout <= 0:
+                self.cache.delete(key)
+                return
+            timeout = min(timeout, self.timeout)
+        else:
+            timeout = self.timeout
+        self.cache.set(key, value, timeout)
+
+    def publish(self, keys):
+        """本地删除并广播给其他进程,keys为None时清空全部"""
+        if keys is None:
+            self.cache.clear()
+        else:
+            self.cache.delete_many(keys)
+        message = json.dumps({'node': self.node_id, 'keys': keys})
+        try:
+            self.client.publish(self.channel, message)
+        except Exception as e:
+            logger.error('publish cache invalidation error:{e}'.format(e=e))
+
+    def _listen(self):
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                self.ready = True
+                for message in pubsub.listen():
+                    self._invalidate(message['data'])
+            except Exception as e:
+                logger.warning('cache invalidation subscriber error:{e}'.format(e=e))
+            finally:
+                self.ready = False
+                self.cache.clear()
+                pubsub.close()
+            time.sleep(1)
+
+    def _invalidate(self, data):
+        message = json.loads(data)
+        if message['node'] == self.node_id:
+            return
+        self.record('invalidations')
+        if message['keys'] is None:
+            self.cache.clear()
+        else:
+            self.cache.delete_many(message['keys'])
+
+
+_local_tiers = {}
+_local_tiers_lock = threading.Lock()
+
+
+class TwoTierRedisCache(RedisCache):
+    """
+    redis作为所有进程共享的二级缓存,进程内保留一层短时间的一级缓存.
+    写入和删除时通过redis发布订阅广播key,各进程删除本地副本;
+    与广播同时发生的读取可能把旧值放回一级缓存,最多保留L1_TIMEOUT秒.
+
+    OPTIONS:
+    L1_TIMEOUT: 一级缓存最长保存秒数,默认5
+    L1_MAX_ENTRIES: 一级缓存最多条目数,默认1000
+    INVALIDATION_CHANNEL: 失效广播的频道
+    STATS_FLUSH_INTERVAL: 每隔多少秒把命中统计累加到redis,默认60
+    """
+
+    def __init__(self, server, params):
+        params = dict(params)
+        options = dict(params.get('OPTIONS', {}))
+        self._l1_timeout = options.pop('L1_TIMEOUT', 5)
+        self._l1_max_entries = options.pop('L1_MAX_ENTRIES', 1000)
+        self._channel = options.pop('INVALIDATION_CHANNEL', 'djangoblog:cache:invalidation')
+        stats_flush_interval = options.pop('STATS_FLUSH_INTERVAL', 60)
+        params['OPTIONS'] = options
+        super().__init__(server, params)
+        self._stats_key = self._channel + ':stats'
+        self._stats_flusher = BackgroundFlusher(
+            'cache-stats-flusher', self.flush_stats, stats_flush_interval)
+
+    @property
+    def _l1(self):
+        # 缓存实例每个线程一个,一级缓存按进程共用; fork之后重新创建
+        name = 'two-tier-l1:' + self._channel
+        tier = _local_tiers.get(name)
+        if tier is None or tier.pid != os.getpid():
+            with _local_tiers_lock:
+                tier = _local_tiers.get(name)
+                if tier is None or tier.pid != os.getpid():
+                    tier = LocalTier(
+                        name, self._cache.get_client(write=True), self._channel,
+                        self._l1_timeout, self._l1_max_entries)
+                    _local_tiers[name] = tier
+                    self._stats_flusher.start()
+        return tier
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        l1 = self._l1
+        value = l1.get(key)
+        if value is not _MISSING:
+            l1.record('l1_hits')
+            return value
+        l1.record('l1_misses')
+        value = self._cache.get(key, _MISSING)
+        if value is _MISSING:
+            l1.record('l2_misses')
+            return default
+        l1.record('l2_hits')
+        l1.set(key, value, self._l1_timeout)
+        return value
+
+    def get_many(self, keys, version=None):
+        key_map = {
+            self.make_and_validate_key(key, version=version): key for key in keys
+        }
+        l1 = self._l1
+        result = {}
+        missing = []
+        for key in key_map:
+            value = l1.get(key)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                result[key_map[key]] = value
+        l1.record('l1_hits', len(result))
+        l1.record('l1_misses', len(missing))
+        if missing:
+            found = self._cache.get_many(missing)
+            l1.record('l2_hits', len(found))
+            l1.record('l2_misses', len(missing) - len(found))
+            for key, value in found.items():
+                l1.set(key, value, self._l1_timeout)
+                result[key_map[key]] = value
+        return result
+
+    def has_key(self, key, version=None):
+        made_key = self.make_and_validate_key(key, version=version)
+        if self._l1.get(made_key) is not _MISSING:
+            return True
+        return super().has_key(key, version=version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        super().set(key, value, timeout, version=version)
+        key = self.make_and_validate_key(key, version=version)
+        l1 = self._l1
+        l1.publish([key])
+        l1.set(key, value, self.get_backend_timeout(timeout))
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = super().add(key, value, timeout, version=version)
+        if added:
+            self._l1.publish([self.make_and_validate_key(key, version=version)])
+        return added
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        result = super().set_many(data, timeout, version=version)
+        if data:
+            self._l1.publish([self.make_and_validate_key(key, version=version) for key in data])
+        return result
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        touched = super().touch(key, timeout, version=version)
+        if touched and self.get_backend_timeout(timeout) == 0:
+            self._l1.publish([self.make_and_validate_key(key, version=version)])
+        return touched
+
+    def delete(self, key, version=None):
+        deleted = super().delete(key, version=version)
+        self._l1.publish([self.make_and_validate_key(key, version=version)])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        super().delete_many(keys, version=version)
+        if keys:
+            self._l1.publish([self.make_and_validate_key(key, version=version) for key in keys])
+
+    def incr(self, key, delta=1, version=None):
+        value = super().incr(key, delta, version=version)
+        self._l1.publish([self.make_and_validate_key(key, version=version)])
+        return value
+
+    def clear(self):
+        result = super().clear()
+        self._l1.publish(None)
+        return result
+
+    def flush_stats(self):
+        """把本进程的命中统计累加到redis,所有进程共享"""
+        stats = self._l1.take_stats()
+        if not stats:
+            return
+        client = self._cache.get_client(write=True)
+        pipeline = client.pipeline()
+        for name, count in stats.items():
+            pipeline.hincrby(self._stats_key, name, count)
+        pipeline.execute()
+
+    def get_stats(self):
+        """
+        所有进程的命中统计,以及本进程尚未累加到redis的部分
+        :return: {'l1': {...}, 'l2': {...}, 'invalidations': n}
+        """
+        stats = Counter({
+            name.decode(): int(count)
+            for name, count in self._cache.get_client().hgetall(self._stats_key).items()})
+        stats.update(self._l1.stats)
+        result = {'invalidations': stats['invalidations']}
+        for tier in ('l1', 'l2'):
+            hits, misses = stats[tier + '_hits'], stats[tier + '_misses']
+            result[tier] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            }
+        return result
+
+    def reset_stats(self):
+        self._l1.take_stats()
+        self._cache.get_client(write=True).delete(self._stats_key)
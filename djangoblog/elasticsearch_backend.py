@@ -26,14 +26,13 @@ class ElasticSearchBackend(BaseSearchBackend):
         self.include_spelling = True
 
     def _get_models(self, iterable):
-        models = iterable if iterable and iterable[0] else Article.objects.all()
+        models = iterable if iterable and iterable[0] else self.manager.get_queryset()
         docs = self.manager.convert_to_doc(models)
         return docs
 
     def _create(self, models):
         self.manager.create_index()
-        docs = self._get_models(models)
-        self.manager.rebuild(docs)
+        self.manager.rebuild(models if models and models[0] else None)
 
     def _delete(self, models):
         for m in models:
@@ -41,9 +40,7 @@ class ElasticSearchBackend(BaseSearchBackend):
         return True
 
     def _rebuild(self, models):
-        models = models if models else Article.objects.all()
-        docs = self.manager.convert_to_doc(models)
-        self.manager.update_docs(docs)
+        self.manager.rebuild(models if models else None)
 
     def update(self, index, iterable, commit=True):
 
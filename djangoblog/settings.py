@@ -350,6 +350,8 @@ BOOTSTRAP_COLOR_TYPES = [
 
 # paginate 分页的页大小为10
 PAGINATE_BY = 10
+# 页码大于该值的文章列表页使用游标分页
+PAGINATE_BY_CURSOR_AFTER = 5
 # http cache timeout HTTP缓存的最长有效期为2592000秒（30天）
 CACHE_CONTROL_MAX_AGE = 2592000
 # cache setting
@@ -362,23 +364,38 @@ CACHES = {
         'LOCATION': 'unique-snowflake',
     }
 }
-# 使用redis作为缓存
-DJANGO_REDIS_URL = 'redis://:@localhost:6379/0'
-# if os.environ.get("DJANGO_REDIS_URL"):
-#     CACHES = {
-#         'default': {
-#             'BACKEND': 'django.core.cache.backends.redis.RedisCache',
-#             'LOCATION': f'redis://{os.environ.get("DJANGO_REDIS_URL")}',
-#         }
-#     }
-#
-# if DJANGO_REDIS_URL:
-#     CACHES = {
-#         'default': {
-#             'BACKEND': 'django.core.cache.backends.redis.RedisCache',
-#             'LOCATION': DJANGO_REDIS_URL,
-#         }
-#     }
+# 匿名用户整页缓存的过期时间
+PAGE_CACHE_TIMEOUT = 60 * 10
+# 文章阅读数在进程内缓冲, 每隔多少秒批量写入数据库, 为0时每次访问立即写入
+ARTICLE_VIEWS_FLUSH_INTERVAL = 0 if TESTING else 30
+# 邮件先写入发件箱, 由后台线程每隔多少秒批量发送, 为0时立即发送,
+# 为None时进程内不发送, 只由 send_emails 命令发送
+EMAIL_OUTBOX_FLUSH_INTERVAL = 0 if TESTING else 10
+# 开启ES时记录页面耗时: 每隔多少秒批量写入, 缓冲区最多保存的记录数(满时丢弃), 采样比例
+ELAPSED_TIME_SHIP_INTERVAL = 5
+ELAPSED_TIME_BUFFER_SIZE = 10000
+ELAPSED_TIME_SAMPLE_RATE = 1.0
+# markdown渲染结果缓存: 进程内LRU的最大条目数, 共享缓存中的过期时间
+MARKDOWN_RENDER_CACHE_SIZE = 1000
+MARKDOWN_RENDER_CACHE_TIMEOUT = 60 * 60 * 24
+# 设置DJANGO_REDIS_URL环境变量(如 redis:6379)时使用redis作为所有进程共享的缓存,
+# 进程内另有一层短时间的本地缓存, 写入时通过redis发布订阅通知其他进程删除本地副本
+DJANGO_REDIS_URL = os.environ.get('DJANGO_REDIS_URL')
+if DJANGO_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'djangoblog.cache_backend.TwoTierRedisCache',
+            'TIMEOUT': 10800,
+            'LOCATION': DJANGO_REDIS_URL if '://' in DJANGO_REDIS_URL else f'redis://{DJANGO_REDIS_URL}',
+            'OPTIONS': {
+                # 本地缓存最长保存秒数和最多条目数
+                'L1_TIMEOUT': 5,
+                'L1_MAX_ENTRIES': 1000,
+                # 每隔多少秒把各级缓存的命中统计累加到redis
+                'STATS_FLUSH_INTERVAL': 60,
+            },
+        }
+    }
 
 """
 这个URL是用于向百度搜索引擎主动推送网站更新信息的接口地址。具体来说：
@@ -391,6 +408,18 @@ token=1uAOGrMsUm5syDGn 是百度为特定网站生成的一个验证令牌，用
 SITE_ID = 1
 BAIDU_NOTIFY_URL = os.environ.get('DJANGO_BAIDU_NOTIFY_URL') \
                    or 'http://data.zz.baidu.com/urls?site=https://www.lylinux.net&token=1uAOGrMsUm5syDGn'
+# 百度单次推送的url数量上限
+BAIDU_NOTIFY_BATCH_SIZE = 2000
+# 推送请求超时秒数
+SPIDER_NOTIFY_TIMEOUT = 10
+# 保存时记录的url每隔多少秒合并推送一次, 同一url在此时间内只推送一次
+SPIDER_NOTIFY_INTERVAL = 60
+# 静态站点地图: sitemap.xml索引和sitemaps/下的分片写入的目录(需与nginx的root一致),
+# 每个分片包含的主键区间大小, 保存时记录的分片每隔多少秒重新生成一次,
+# 为None时进程内不生成, 只由 build_sitemap 命令生成
+SITEMAP_ROOT = STATIC_ROOT
+SITEMAP_SHARD_SIZE = 5000
+SITEMAP_UPDATE_INTERVAL = None if TESTING else 60
 
 # Email:
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -1,7 +1,21 @@
+import gzip
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.sitemaps import Sitemap
+from django.contrib.sitemaps.views import SitemapIndexItem
+from django.template import loader
 from django.urls import reverse
 
 from blog.models import Article, Category, Tag
+from djangoblog.utils import BackgroundFlusher, get_current_site
+
+logger = logging.getLogger(__name__)
 
 
 class StaticViewSitemap(Sitemap):
@@ -15,45 +29,237 @@ class StaticViewSitemap(Sitemap):
         return reverse(item)
 
 
-class ArticleSiteMap(Sitemap):
+class ShardedSitemap(Sitemap):
+    """
+    按主键区间分片: 第n片包含主键在[n*shard_size, (n+1)*shard_size)之间的对象,
+    对象变化时只需重新生成它所在的分片.
+    shard为None时返回全部对象
+    """
+    shard = None
+    shard_size = None
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def items(self):
+        queryset = self.get_queryset()
+        if self.shard is None:
+            return queryset
+        start = self.shard * self.shard_size
+        return queryset.filter(pk__gte=start, pk__lt=start + self.shard_size).order_by('pk')
+
+
+class ArticleSiteMap(ShardedSitemap):
     changefreq = "monthly"
     priority = "0.6"
 
-    def items(self):
-        return Article.objects.filter(status='p')
+    def get_queryset(self):
+        return Article.objects.filter(status='p').links('last_modify_time')
 
     def lastmod(self, obj):
         return obj.last_modify_time
 
 
-class CategorySiteMap(Sitemap):
+class CategorySiteMap(ShardedSitemap):
     changefreq = "Weekly"
     priority = "0.6"
 
-    def items(self):
+    def get_queryset(self):
         return Category.objects.all()
 
     def lastmod(self, obj):
         return obj.last_modify_time
 
 
-class TagSiteMap(Sitemap):
+class TagSiteMap(ShardedSitemap):
     changefreq = "Weekly"
     priority = "0.3"
 
-    def items(self):
+    def get_queryset(self):
         return Tag.objects.all()
 
     def lastmod(self, obj):
         return obj.last_modify_time
 
 
-class UserSiteMap(Sitemap):
+class UserSiteMap(ShardedSitemap):
     changefreq = "Weekly"
     priority = "0.3"
 
-    def items(self):
-        return list(set(map(lambda x: x.author, Article.objects.all())))
+    def get_queryset(self):
+        return get_user_model().objects.filter(article__isnull=False).distinct().order_by('id').only(
+            'id', 'username', 'date_joined')
 
     def lastmod(self, obj):
         return obj.date_joined
+
+
+sitemaps = {
+
+    'blog': ArticleSiteMap,
+    'Category': CategorySiteMap,
+    'Tag': TagSiteMap,
+    'User': UserSiteMap,
+    'static': StaticViewSitemap
+}
+
+
+class SitemapGenerator:
+    """
+    静态站点地图
+    每个section按主键区间分片,写成gzip压缩的 sitemaps/<section>-<n>.xml.gz,
+    再写出引用所有分片的 sitemap.xml 索引,都放在SITEMAP_ROOT下由nginx直接提供.
+    保存文章/分类/标签时只记录所在的分片,由后台线程每隔interval秒合并后
+    重新生成这些分片和索引; 内容没有变化的文件不重写,保留原来的修改时间
+    """
+    protocol = 'https'
+    index_name = 'sitemap.xml'
+    shard_dir = 'sitemaps'
+    shard_pattern = re.compile(r'^(?P<section>\w+)-(?P<shard>\d+)\.xml\.gz$')
+
+    def __init__(self, sitemaps, interval):
+        self.sitemaps = sitemaps
+        self.interval = interval
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._flusher = BackgroundFlusher('sitemap-generator', self.flush, interval)
+
+    @property
+    def root(self):
+        return settings.SITEMAP_ROOT
+
+    @property
+    def shard_size(self):
+        return settings.SITEMAP_SHARD_SIZE
+
+    def shard_path(self, section, shard):
+        return os.path.join(self.root, self.shard_dir, '{section}-{shard}.xml.gz'.format(
+            section=section.lower(), shard=shard))
+
+    def put(self, section, pk):
+        """
+        记录需要重新生成的分片,interval为None时进程内不生成,只由 build_sitemap 命令生成
+        :param section: sitemaps中的名称
+        :param pk: 变化的对象主键
+        """
+        if self.interval is None or pk is None:
+            return
+        with self._lock:
+            self._pending.add((section, self._get_shard(section, pk)))
+        if self.interval > 0:
+            self._flusher.start()
+        else:
+            self.flush()
+
+    def flush(self):
+        """
+        重新生成记录的分片和索引,还没有生成过索引时全部生成
+        :return: 重新生成的分片数量
+        """
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        if not pending:
+            return 0
+        if not os.path.exists(os.path.join(self.root, self.index_name)):
+            return self.generate()
+        site = get_current_site()
+        for section, shard in sorted(pending):
+            self._write_shard(site, section, shard)
+        self._write_index(site)
+        logger.info('update sitemap shards:{shards}'.format(shards=sorted(pending)))
+        return len(pending)
+
+    def generate(self):
+        """
+        生成全部分片和索引,删除已经没有对象的分片
+        :return: 分片数量
+        """
+        site = get_current_site()
+        paths = set()
+        for section in self.sitemaps:
+            for shard in self._get_shards(section):
+                if self._write_shard(site, section, shard):
+                    paths.add(self.shard_path(section, shard))
+        for path in self._list_shards():
+            if path not in paths:
+                os.remove(path)
+        self._write_index(site)
+        logger.info('generate sitemap:{count} shards'.format(count=len(paths)))
+        return len(paths)
+
+    def _is_sharded(self, section):
+        return issubclass(self.sitemaps[section], ShardedSitemap)
+
+    def _get_shard(self, section, pk):
+        return pk // self.shard_size if self._is_sharded(section) else 0
+
+    def _get_shards(self, section):
+        if not self._is_sharded(section):
+            return [0]
+        pks = self.sitemaps[section]().get_queryset().values_list('pk', flat=True)
+        return sorted({pk // self.shard_size for pk in pks})
+
+    def _write_shard(self, site, section, shard):
+        """
+        生成一个分片,没有对象时删除分片文件
+        :return: 分片中是否有url
+        """
+        sitemap = self.sitemaps[section]()
+        if self._is_sharded(section):
+            sitemap.shard = shard
+            sitemap.shard_size = self.shard_size
+        urls = sitemap.get_urls(page=1, site=site, protocol=self.protocol)
+        path = self.shard_path(section, shard)
+        if not urls:
+            if os.path.exists(path):
+                os.remove(path)
+            return False
+        content = loader.render_to_string('sitemap.xml', {'urlset': urls})
+        self._write_file(path, gzip.compress(content.encode('utf-8'), mtime=0))
+        return True
+
+    def _list_shards(self):
+        directory = os.path.join(self.root, self.shard_dir)
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name) for name in os.listdir(directory)
+                if self.shard_pattern.match(name)]
+
+    def _write_index(self, site):
+        # 按sitemaps中的顺序和分片序号排列,lastmod取分片文件的修改时间
+        order = {section.lower(): i for i, section in enumerate(self.sitemaps)}
+        shards = []
+        for path in self._list_shards():
+            match = self.shard_pattern.match(os.path.basename(path))
+            if match.group('section') in order:
+                shards.append((order[match.group('section')], int(match.group('shard')), path))
+        items = [
+            SitemapIndexItem(
+                '{protocol}://{domain}/{directory}/{name}'.format(
+                    protocol=self.protocol, domain=site.domain,
+                    directory=self.shard_dir, name=os.path.basename(path)),
+                datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc))
+            for _, _, path in sorted(shards)]
+        content = loader.render_to_string('sitemap_index.xml', {'sitemaps': items}).encode('utf-8')
+        path = os.path.join(self.root, self.index_name)
+        # 同时写出压缩版本,供nginx的gzip_static使用
+        self._write_file(path, content)
+        self._write_file(path + '.gz', gzip.compress(content, mtime=0))
+
+    @staticmethod
+    def _write_file(path, content):
+        """先写临时文件再替换,nginx不会读到写了一半的文件; 内容相同时不重写"""
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                if f.read() == content:
+                    return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{path}.{pid}-{thread}.tmp'.format(
+            path=path, pid=os.getpid(), thread=threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return True
+
+
+sitemap_generator = SitemapGenerator(sitemaps, settings.SITEMAP_UPDATE_INTERVAL)
@@ -1,21 +1,51 @@
 import logging
+import threading
+import time
+from collections import OrderedDict
 
 import requests
 from django.conf import settings
 from django.contrib.sitemaps import ping_google
 
+from djangoblog.utils import BackgroundFlusher
+
 logger = logging.getLogger(__name__)
 
+# 复用连接,避免每次推送都重新建立TCP/TLS连接
+session = requests.Session()
+
 
 class SpiderNotify():
     @staticmethod
     def baidu_notify(urls):
-        try:
-            data = '\n'.join(urls)
-            result = requests.post(settings.BAIDU_NOTIFY_URL, data=data)
-            logger.info(result.text)
-        except Exception as e:
-            logger.error(e)
+        """
+        推送url到百度,按百度单次推送的url数量上限分批发送
+        :return: 推送成功的url数量
+        """
+        return sum(len(chunk) for chunk, ok in SpiderNotify.baidu_notify_batches(urls) if ok)
+
+    @staticmethod
+    def baidu_notify_batches(urls):
+        """
+        按百度单次推送的url数量上限分批推送
+        :return: 逐批返回(本批url, 是否推送成功)
+        """
+        urls = list(urls)
+        batch_size = settings.BAIDU_NOTIFY_BATCH_SIZE
+        for i in range(0, len(urls), batch_size):
+            chunk = urls[i:i + batch_size]
+            ok = False
+            try:
+                data = '\n'.join(chunk)
+                result = session.post(
+                    settings.BAIDU_NOTIFY_URL,
+                    data=data,
+                    timeout=settings.SPIDER_NOTIFY_TIMEOUT)
+                logger.info(result.text)
+                ok = result.ok
+            except Exception as e:
+                logger.error(e)
+            yield chunk, ok
 
     @staticmethod
     def __google_notify():
@@ -27,5 +57,78 @@ class SpiderNotify():
     @staticmethod
     def notify(url):
 
-        SpiderNotify.baidu_notify(url)
+        SpiderNotify.baidu_notify([url])
         SpiderNotify.__google_notify()
+
+
+class SpiderNotifyQueue:
+    """
+    待推送url队列
+    保存时只记录url,由后台线程每隔interval秒合并后批量推送,
+    interval时间内推送过的url不再重复推送.
+    推送失败的url放回队列重试,失败max_retries次后丢弃;
+    整次推送都失败时(百度不可用或超出配额)按指数退避推迟下次推送
+    """
+    # 退避时最多推迟的推送间隔倍数
+    MAX_BACKOFF = 64
+
+    def __init__(self, interval, max_retries=5):
+        self.interval = interval
+        self.max_retries = max_retries
+        # url -> 已失败次数
+        self._pending = OrderedDict()
+        self._notified = {}
+        self._failures = 0
+        self._retry_time = 0
+        self._lock = threading.Lock()
+        self._flusher = BackgroundFlusher('spider-notify', self.flush, interval)
+
+    def put(self, url):
+        with self._lock:
+            notified_time = self._notified.get(url)
+            if notified_time and time.time() - notified_time < self.interval:
+                return
+            self._pending.setdefault(url, 0)
+        if self.interval > 0:
+            self._flusher.start()
+        else:
+            self.flush()
+
+    def flush(self):
+        """
+        推送队列中的url,退避期间不推送
+        :return: 本次推送成功的url数量
+        """
+        with self._lock:
+            if not self._pending or time.time() < self._retry_time:
+                return 0
+            pending, self._pending = self._pending, OrderedDict()
+        notified, failed = [], []
+        for chunk, ok in SpiderNotify.baidu_notify_batches(pending):
+            (notified if ok else failed).extend(chunk)
+        now = time.time()
+        dropped = []
+        with self._lock:
+            self._notified = {
+                url: t for url, t in self._notified.items() if now - t < self.interval}
+            self._notified.update((url, now) for url in notified)
+            for url in failed:
+                attempts = pending[url] + 1
+                if attempts >= self.max_retries:
+                    dropped.append(url)
+                elif url not in self._pending:
+                    self._pending[url] = attempts
+            if notified or not failed:
+                self._failures = 0
+                self._retry_time = 0
+            else:
+                self._failures += 1
+                self._retry_time = now + self.interval * min(2 ** self._failures, self.MAX_BACKOFF)
+        if dropped:
+            logger.warning('drop spider notify urls after {count} failures:{urls}'.format(
+                count=self.max_retries, urls=dropped))
+        logger.info('notify spider:{count}/{total} urls'.format(count=len(notified), total=len(pending)))
+        return len(notified)
+
+
+spider_notify_queue = SpiderNotifyQueue(settings.SPIDER_NOTIFY_INTERVAL)
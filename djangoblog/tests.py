@@ -1,3 +1,5 @@
+from unittest.mock import patch
+
 from django.test import TestCase
 
 from djangoblog.utils import *
@@ -30,3 +32,175 @@ class DjangoBlogTest(TestCase):
         }
         data = parse_dict_to_url(d)
         self.assertIsNotNone(data)
+
+    def test_markdown_render_cache(self):
+        CommonMarkdown.clear_render_cache()
+        cache.clear()
+        content = '**bold** <script>alert(1)</script>'
+        sanitized = CommonMarkdown.get_markdown(content, sanitize=True)
+        self.assertNotIn('<script>', sanitized)
+        self.assertEqual(sanitized, CommonMarkdown.get_markdown(content, sanitize=True))
+        self.assertIn('<script>', CommonMarkdown.get_markdown(content))
+        info = CommonMarkdown.get_render_cache_info()
+        self.assertEqual(info['misses'], 2)
+        self.assertEqual(info['local_hits'], 1)
+
+        CommonMarkdown.clear_render_cache()
+        CommonMarkdown.get_markdown(content, sanitize=True)
+        info = CommonMarkdown.get_render_cache_info()
+        self.assertEqual(info['shared_hits'], 1)
+        self.assertEqual(info['misses'], 0)
+
+    def test_cache_tags(self):
+        key = make_tagged_cache_key('tagged', [cache_tag('article', 1), 'sidebar'])
+        self.assertEqual(key, make_tagged_cache_key('tagged', ['sidebar', cache_tag('article', 1)]))
+        cache.set(key, 'value')
+        invalidate_cache_tags(cache_tag('article', 2))
+        self.assertEqual(cache.get(make_tagged_cache_key('tagged', [cache_tag('article', 1), 'sidebar'])), 'value')
+        invalidate_cache_tags(cache_tag('article', 1))
+        new_key = make_tagged_cache_key('tagged', [cache_tag('article', 1), 'sidebar'])
+        self.assertNotEqual(key, new_key)
+        self.assertIsNone(cache.get(new_key))
+
+    def test_cache_single_flight(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.3)
+            return len(calls)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            get_or_set_cache('single_flight', compute, 60, single_flight=True))) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [1] * 5)
+
+        # 不新鲜的值: 其他请求正在刷新时返回旧值,拿到锁时重新计算
+        cache.set('single_flight', CacheEntry('stale', time.time() - 1), 60)
+        cache.add('single_flight:lock', 1, 10)
+        self.assertEqual(get_or_set_cache('single_flight', lambda: 'fresh', 60, soft_expiration=30), 'stale')
+        cache.delete('single_flight:lock')
+        self.assertEqual(get_or_set_cache('single_flight', lambda: 'fresh', 60, soft_expiration=30), 'fresh')
+        self.assertEqual(get_or_set_cache('single_flight', lambda: 'newer', 60, soft_expiration=30), 'fresh')
+        self.assertIsNone(cache.get('single_flight:lock'))
+
+        # 计算超过锁的持有时间后,锁已被其他请求拿到,不能删除其他请求的锁
+        def slow_compute():
+            cache.set('single_flight:lock', 'other', 10)
+            return 'slow'
+
+        cache.delete('single_flight')
+        self.assertEqual(get_or_set_cache('single_flight', slow_compute, 60, single_flight=True), 'slow')
+        self.assertEqual(cache.get('single_flight:lock'), 'other')
+
+    def test_spider_notify_queue(self):
+        from djangoblog.spider_notify import SpiderNotify, SpiderNotifyQueue
+        with self.settings(BAIDU_NOTIFY_URL='http://127.0.0.1:1/urls', BAIDU_NOTIFY_BATCH_SIZE=2,
+                           SPIDER_NOTIFY_TIMEOUT=1):
+            self.assertEqual(SpiderNotify.baidu_notify(['https://a/1', 'https://a/2', 'https://a/3']), 0)
+
+            queue = SpiderNotifyQueue(60, max_retries=2)
+            # 不启动后台线程,直接调用flush
+            with patch.object(queue._flusher, 'start') as start, \
+                    patch('djangoblog.spider_notify.session.post') as post:
+                queue.put('https://a/1')
+                queue.put('https://a/1')
+                queue.put('https://a/2')
+                self.assertTrue(start.called)
+                # 推送失败的url不记为已推送,留在队列中重试;退避期间不再推送
+                post.side_effect = ConnectionError('refused')
+                self.assertEqual(queue.flush(), 0)
+                self.assertEqual(queue.flush(), 0)
+                self.assertEqual(post.call_count, 1)
+
+                post.side_effect = None
+                post.return_value.ok = True
+                post.return_value.text = ''
+                with patch('djangoblog.spider_notify.time.time', return_value=time.time() + 120):
+                    self.assertEqual(queue.flush(), 2)
+                    self.assertEqual(post.call_args.kwargs['data'], 'https://a/1\nhttps://a/2')
+                    queue.put('https://a/1')
+                    self.assertEqual(queue.flush(), 0)
+                    self.assertEqual(post.call_count, 2)
+
+                # 失败max_retries次后丢弃
+                post.side_effect = ConnectionError('refused')
+                queue.put('https://a/3')
+                now = time.time()
+                for i in range(2):
+                    now += 60 * 64
+                    with patch('djangoblog.spider_notify.time.time', return_value=now):
+                        self.assertEqual(queue.flush(), 0)
+                self.assertEqual(post.call_count, 4)
+                self.assertFalse(queue._pending)
+
+    def test_parse_user_agent(self):
+        ua_string = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 ' \
+                    '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+        parse_user_agent.cache_clear()
+        user_agent = parse_user_agent(ua_string)
+        self.assertEqual(user_agent.browser.family, 'Chrome')
+        self.assertIs(parse_user_agent(ua_string), user_agent)
+        info = get_user_agent_cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (1, 1, 1))
+        self.assertEqual(info['hit_rate'], 0.5)
+
+    def test_request_timing_exclusive(self):
+        # 模板渲染中的数据库查询只算在db里,template只记自身耗时
+        token = start_request_timings()
+        try:
+            with patch('djangoblog.utils.time.perf_counter', side_effect=[0.0, 1.0, 3.0, 6.0]):
+                with request_timing('template'):
+                    with request_timing('db'):
+                        pass
+        finally:
+            timings = stop_request_timings(token)
+        self.assertEqual(timings, {'template': 4.0, 'db': 2.0})
+
+    def test_two_tier_cache(self):
+        redis_url = os.environ.get('DJANGO_REDIS_URL')
+        if not redis_url:
+            self.skipTest('DJANGO_REDIS_URL is not set')
+        import json
+        from djangoblog.cache_backend import TwoTierRedisCache
+        location = redis_url if '://' in redis_url else 'redis://' + redis_url
+        two_tier = TwoTierRedisCache(location, {
+            'KEY_PREFIX': 'two_tier_test',
+            'OPTIONS': {'INVALIDATION_CHANNEL': 'djangoblog:test:invalidation'}})
+        two_tier.clear()
+        two_tier.reset_stats()
+        for i in range(50):
+            if two_tier._l1.ready:
+                break
+            time.sleep(0.1)
+
+        two_tier.set('key', 'value')
+        self.assertEqual(two_tier.get('key'), 'value')
+        stats = two_tier.get_stats()
+        self.assertEqual(stats['l1']['hits'], 1)
+        self.assertEqual(stats['l2']['hits'], 0)
+
+        # 其他进程写入后广播,本地副本被删除,再次读取时从redis获取
+        key = two_tier.make_and_validate_key('key')
+        two_tier._cache.set(key, 'new value', 60)
+        client = two_tier._cache.get_client(write=True)
+        client.publish('djangoblog:test:invalidation', json.dumps({'node': 'other', 'keys': [key]}))
+        for i in range(50):
+            if two_tier._l1.get(key) != 'value':
+                break
+            time.sleep(0.1)
+        self.assertEqual(two_tier.get('key'), 'new value')
+        stats = two_tier.get_stats()
+        self.assertEqual(stats['l2']['hits'], 1)
+        self.assertEqual(stats['invalidations'], 1)
+
+        self.assertEqual(two_tier.get_many(['key', 'missing']), {'key': 'new value'})
+        two_tier.delete('key')
+        self.assertIsNone(two_tier.get('key'))
+        two_tier.clear()
+        two_tier.reset_stats()
@@ -2,11 +2,18 @@
 # encoding: utf-8
 
 
+import atexit
 import logging
 import os
 import random
 import string
+import threading
+import time
 import uuid
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache, wraps
 from hashlib import sha256
 
 import bleach
@@ -14,11 +21,80 @@ import markdown
 import requests
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.cache import cache
+from django.core.cache import cache as django_cache
 from django.templatetags.static import static
 
 logger = logging.getLogger(__name__)
 
+# 当前请求各部分的耗时(秒),由OnlineMiddleware开启,用于Server-Timing响应头
+_request_timings = ContextVar('request_timings', default=None)
+
+
+def start_request_timings():
+    """开始记录当前请求的耗时,返回用于reset的token"""
+    return _request_timings.set(defaultdict(float))
+
+
+def stop_request_timings(token):
+    """结束记录,返回{名称: 秒数}"""
+    timings = _request_timings.get()
+    _request_timings.reset(token)
+    return dict(timings) if timings is not None else {}
+
+
+def add_request_timing(name, seconds):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] += seconds
+
+
+@contextmanager
+def request_timing(name):
+    """记录代码块的耗时,不在请求中时不记录
+
+    只记自身耗时:块内嵌套记录的db,cache,markdown等会从中扣除,
+    以免同一段时间在Server-Timing里被算两次
+    """
+    timings = _request_timings.get()
+    if timings is None:
+        yield
+        return
+    nested_before = sum(timings.values())
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = sum(timings.values()) - nested_before
+        add_request_timing(name, max(elapsed - nested, 0.0))
+
+
+class TimedCache:
+    """缓存代理,记录缓存操作的耗时"""
+    TIMED_METHODS = frozenset([
+        'get', 'set', 'add', 'delete', 'get_many', 'set_many', 'delete_many',
+        'incr', 'decr', 'get_or_set', 'has_key', 'touch', 'clear'])
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name not in self.TIMED_METHODS:
+            return attr
+
+        def timed(*args, **kwargs):
+            with request_timing('cache'):
+                return attr(*args, **kwargs)
+
+        return timed
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+
+cache = TimedCache(django_cache)
+
 
 def get_max_articleid_commentid():
     from blog.models import Article
@@ -31,42 +107,255 @@ def get_sha256(str):
     return m.hexdigest()
 
 
-def cache_decorator(expiration=3 * 60):
+CACHE_TAG_PREFIX = 'cache_tag_'
+
+
+def cache_tag(name, pk=None):
+    """
+    生成缓存标签名,如 cache_tag('article', 1) -> 'article:1'
+    :param name: 标签类型
+    :param pk: 对象id,为空时表示整个类型
+    """
+    return name if pk is None else '{name}:{pk}'.format(name=name, pk=pk)
+
+
+def get_cache_tag_versions(tags):
+    """
+    获得缓存标签当前的版本号(generation),不存在的标签用当前时间初始化
+    :param tags: 标签列表
+    :return: {tag: version}
+    """
+    keys = {CACHE_TAG_PREFIX + tag: tag for tag in tags}
+    versions = cache.get_many(list(keys))
+    for key in keys:
+        if key not in versions:
+            seed = int(time.time() * 1000)
+            cache.add(key, seed, None)
+            versions[key] = cache.get(key, seed)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def make_tagged_cache_key(key, tags):
+    """
+    将标签的版本号拼接进缓存key,标签失效后旧key自然不再被访问,无需扫描删除
+    :param key: 原始缓存key
+    :param tags: 该缓存依赖的标签
+    :return: 带版本的缓存key
+    """
+    if not tags:
+        return key
+    versions = get_cache_tag_versions(sorted(set(tags)))
+    version_str = ','.join(
+        '{tag}={version}'.format(tag=tag, version=versions[tag]) for tag in sorted(versions))
+    return '{key}:{hash}'.format(key=key, hash=get_sha256(version_str)[:16])
+
+
+def invalidate_cache_tags(*tags):
+    """
+    使依赖这些标签的缓存失效
+    :param tags: 标签
+    """
+    for tag in set(tags):
+        key = CACHE_TAG_PREFIX + tag
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time() * 1000), None)
+        logger.debug('invalidate cache tag:{tag}'.format(tag=tag))
+
+
+# 缓存的值和它保持新鲜的截止时间(为None时在过期前一直新鲜)
+CacheEntry = namedtuple('CacheEntry', ['value', 'fresh_until'])
+# 计算缓存的锁最多持有的秒数,等待其他请求计算时的轮询间隔
+CACHE_LOCK_TIMEOUT = 10
+CACHE_LOCK_WAIT_INTERVAL = 0.05
+
+
+def acquire_cache_lock(lock_key, timeout=CACHE_LOCK_TIMEOUT):
+    """
+    尝试拿锁,不等待
+    :return: 拿到锁时返回本次持有的token,否则返回None
+    """
+    token = uuid.uuid4().hex
+    return token if cache.add(lock_key, token, timeout) else None
+
+
+def release_cache_lock(lock_key, token):
+    """
+    只释放自己持有的锁.持有时间超过timeout后锁已过期,可能已被其他请求拿到,不能删除
+    """
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
+def get_or_set_cache(key, compute, expiration, soft_expiration=None, single_flight=False):
+    """
+    读取缓存,不存在时调用compute计算并写入
+    :param key: 缓存key
+    :param compute: 无参数的函数,返回要缓存的值(可以为None)
+    :param expiration: 过期秒数
+    :param soft_expiration: 值保持新鲜的秒数,应小于expiration.超过后在过期前仍返回旧值,
+        同时由拿到锁的一个请求重新计算(stale-while-revalidate)
+    :param single_flight: 缓存不存在时只有拿到锁的一个请求计算,其他请求等待结果,
+        避免热点key过期或清空缓存后所有请求同时计算
+    """
+    entry = cache.get(key)
+    if isinstance(entry, CacheEntry):
+        if entry.fresh_until is None or time.time() < entry.fresh_until:
+            return entry.value
+        # 已经不新鲜,拿不到锁说明有其他请求在刷新,先返回旧值
+        token = acquire_cache_lock(key + ':lock')
+        if token is None:
+            return entry.value
+        return _compute_cache(key, compute, expiration, soft_expiration, token)
+
+    if not single_flight:
+        return _compute_cache(key, compute, expiration, soft_expiration, None)
+    token = acquire_cache_lock(key + ':lock')
+    if token is not None:
+        return _compute_cache(key, compute, expiration, soft_expiration, token)
+    deadline = time.time() + CACHE_LOCK_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(CACHE_LOCK_WAIT_INTERVAL)
+        entry = cache.get(key)
+        if isinstance(entry, CacheEntry):
+            return entry.value
+    logger.warning('wait for cache timeout, compute it directly:{key}'.format(key=key))
+    return compute()
+
+
+def _compute_cache(key, compute, expiration, soft_expiration, token):
+    logger.debug('compute cache:{key}'.format(key=key))
+    try:
+        value = compute()
+        fresh_until = time.time() + soft_expiration if soft_expiration else None
+        cache.set(key, CacheEntry(value, fresh_until), expiration)
+        return value
+    finally:
+        if token is not None:
+            release_cache_lock(key + ':lock', token)
+
+
+@contextmanager
+def cache_lock(key, timeout=CACHE_LOCK_TIMEOUT, wait=None):
+    """
+    基于cache.add的跨进程锁,最多持有timeout秒
+    :param wait: 拿不到锁时最多等待的秒数,默认为timeout,为0时不等待
+    :return: 是否拿到锁
+    """
+    lock_key = key + ':lock'
+    deadline = time.time() + (timeout if wait is None else wait)
+    token = acquire_cache_lock(lock_key, timeout)
+    while token is None and time.time() < deadline:
+        time.sleep(CACHE_LOCK_WAIT_INTERVAL)
+        token = acquire_cache_lock(lock_key, timeout)
+    try:
+        yield token is not None
+    finally:
+        if token is not None:
+            release_cache_lock(lock_key, token)
+
+
+def cache_decorator(expiration=3 * 60, tags=None, soft_expiration=None, single_flight=False):
+    """
+    缓存函数的返回值.
+    key由函数的模块和限定名、model实例的label和主键、其余参数的hash组成,不同进程和重启后保持一致;
+    第一个参数是model实例时(model方法),key还依赖该model的标签(如'article'),model保存时整体失效.
+    被装饰的函数带有invalidate(*args, **kwargs),使用与调用时相同的参数删除对应的缓存,
+    如 Tag.get_article_count.invalidate(tag)
+    :param expiration: 过期秒数
+    :param tags: 依赖的缓存标签
+    :param soft_expiration: 见get_or_set_cache
+    :param single_flight: 见get_or_set_cache
+    """
     def wrapper(func):
+        name = '{module}.{name}'.format(module=func.__module__, name=func.__qualname__)
+
+        def make_key(args, kwargs):
+            from django.db.models import Model
+            key_tags = list(tags or [])
+            parts = [name]
+            if args and isinstance(args[0], Model):
+                instance, args = args[0], args[1:]
+                parts.append('{label}:{pk}'.format(label=instance._meta.label_lower, pk=instance.pk))
+                key_tags.append(cache_tag(instance._meta.model_name))
+            if args or kwargs:
+                parts.append(get_sha256(repr((
+                    [_cache_key_arg(arg) for arg in args],
+                    sorted((k, _cache_key_arg(v)) for k, v in kwargs.items()))))[:16])
+            return make_tagged_cache_key(':'.join(parts), key_tags)
+
+        @wraps(func)
         def news(*args, **kwargs):
-            try:
-                view = args[0]
-                key = view.get_cache_key()
-            except:
-                key = None
-            if not key:
-                unique_str = repr((func, args, kwargs))
-
-                m = sha256(unique_str.encode('utf-8'))
-                key = m.hexdigest()
-            value = cache.get(key)
-            if value is not None:
-                # logger.info('cache_decorator get cache:%s key:%s' % (func.__name__, key))
-                if str(value) == '__default_cache_value__':
-                    return None
-                else:
-                    return value
-            else:
-                logger.debug(
-                    'cache_decorator set cache:%s key:%s' %
-                    (func.__name__, key))
-                value = func(*args, **kwargs)
-                if value is None:
-                    cache.set(key, '__default_cache_value__', expiration)
-                else:
-                    cache.set(key, value, expiration)
-                return value
+            return get_or_set_cache(
+                make_key(args, kwargs), lambda: func(*args, **kwargs), expiration,
+                soft_expiration=soft_expiration, single_flight=single_flight)
+
+        def invalidate(*args, **kwargs):
+            cache.delete(make_key(args, kwargs))
 
+        news.invalidate = invalidate
         return news
 
     return wrapper
 
 
+def _cache_key_arg(arg):
+    """model实例用label和主键表示,不依赖__str__/__repr__"""
+    from django.db.models import Model
+    if isinstance(arg, Model):
+        return '{label}:{pk}'.format(label=arg._meta.label_lower, pk=arg.pk)
+    return arg
+
+
+class BackgroundFlusher:
+    """
+    后台守护线程,每隔interval秒调用一次flush,进程退出时再调用一次,
+    用于把请求中缓冲的数据批量写出,避免阻塞请求
+    """
+
+    def __init__(self, name, flush, interval):
+        self.name = name
+        self.flush = flush
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            if self._thread is None:
+                atexit.register(self._flush)
+            self._thread = threading.Thread(
+                target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            logger.info('start background flusher:{name}'.format(name=self.name))
+
+    def wakeup(self):
+        """不等待interval,立即flush一次"""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self._flush()
+
+    def _flush(self):
+        from django.db import connections
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error('{name} flush error:{e}'.format(name=self.name, e=e))
+        finally:
+            # 后台线程有自己的数据库连接,用完即关闭
+            connections.close_all()
+
+
 def expire_view_cache(path, servername, serverport, key_prefix=None):
     '''
     刷新视图缓存
@@ -99,6 +388,14 @@ def get_current_site():
 
 
 class CommonMarkdown:
+    """
+    markdown渲染,渲染结果按(内容hash,是否消毒,是否生成目录)缓存:
+    进程内LRU为一级缓存,共享cache为二级缓存
+    """
+    _render_cache = OrderedDict()
+    _render_cache_lock = threading.Lock()
+    _render_cache_stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
     @staticmethod
     def _convert_markdown(value):
         md = markdown.Markdown(
@@ -114,16 +411,95 @@ class CommonMarkdown:
         return body, toc
 
     @staticmethod
-    def get_markdown_with_toc(value):
+    def _get_render_cache_key(value, sanitize, with_toc):
+        options = 'sanitize={:d}&toc={:d}'.format(sanitize, with_toc)
+        return 'markdown_render_' + get_sha256(options + '\n' + value)
+
+    @classmethod
+    def render(cls, value, sanitize=False, with_toc=False):
+        """
+        渲染markdown并缓存结果
+        :param value: markdown内容
+        :param sanitize: 是否对结果进行html消毒
+        :param with_toc: 是否需要目录
+        :return: (body, toc)
+        """
+        key = cls._get_render_cache_key(value, sanitize, with_toc)
+        with cls._render_cache_lock:
+            if key in cls._render_cache:
+                cls._render_cache.move_to_end(key)
+                cls._render_cache_stats['local_hits'] += 1
+                return cls._render_cache[key]
+
+        result = cache.get(key)
+        if result is None:
+            with request_timing('markdown'):
+                body, toc = cls._convert_markdown(value)
+            if sanitize:
+                body = sanitize_html(body)
+            result = (body, toc if with_toc else '')
+            cache.set(key, result, settings.MARKDOWN_RENDER_CACHE_TIMEOUT)
+            stat = 'misses'
+        else:
+            stat = 'shared_hits'
+
+        with cls._render_cache_lock:
+            cls._render_cache_stats[stat] += 1
+            cls._render_cache[key] = result
+            cls._render_cache.move_to_end(key)
+            while len(cls._render_cache) > settings.MARKDOWN_RENDER_CACHE_SIZE:
+                cls._render_cache.popitem(last=False)
+        return result
+
+    @classmethod
+    def get_render_cache_info(cls):
+        with cls._render_cache_lock:
+            info = dict(cls._render_cache_stats)
+            info['size'] = len(cls._render_cache)
+        return info
+
+    @classmethod
+    def clear_render_cache(cls):
+        with cls._render_cache_lock:
+            cls._render_cache.clear()
+            for k in cls._render_cache_stats:
+                cls._render_cache_stats[k] = 0
+
+    @staticmethod
+    def get_markdown_with_toc(value, use_cache=True):
+        if use_cache:
+            return CommonMarkdown.render(value, with_toc=True)
         body, toc = CommonMarkdown._convert_markdown(value)
         return body, toc
 
     @staticmethod
-    def get_markdown(value):
-        body, toc = CommonMarkdown._convert_markdown(value)
+    def get_markdown(value, sanitize=False):
+        body, toc = CommonMarkdown.render(value, sanitize=sanitize)
         return body
 
 
+@lru_cache(maxsize=1024)
+def parse_user_agent(ua_string):
+    """
+    解析User-Agent.解析需要大量正则匹配,而实际访问中不同的User-Agent很少,
+    所以按原始字符串缓存解析结果
+    """
+    from user_agents import parse
+    return parse(ua_string)
+
+
+def get_user_agent_cache_info():
+    info = parse_user_agent.cache_info()
+    total = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'hit_rate': info.hits / total if total else 0,
+        'size': info.currsize,
+        'maxsize': info.maxsize
+    }
+
+
 def send_email(emailto, title, content):
     from djangoblog.blog_signals import send_email_signal
     send_email_signal.send(
@@ -146,31 +522,31 @@ def parse_dict_to_url(dict):
 
 
 def get_blog_setting():
-    value = cache.get('get_blog_setting')
-    if value:
-        return value
-    else:
-        from blog.models import BlogSettings
-        if not BlogSettings.objects.count():
-            setting = BlogSettings()
-            setting.site_name = 'djangoblog'
-            setting.site_description = '基于Django的博客系统'
-            setting.site_seo_description = '基于Django的博客系统'
-            setting.site_keywords = 'Django,Python'
-            setting.article_sub_length = 300
-            setting.sidebar_article_count = 10
-            setting.sidebar_comment_count = 5
-            setting.show_google_adsense = False
-            setting.open_site_comment = True
-            setting.analytics_code = ''
-            setting.beian_code = ''
-            setting.show_gongan_code = False
-            setting.comment_need_review = False
-            setting.save()
-        value = BlogSettings.objects.first()
-        logger.info('set cache get_blog_setting')
-        cache.set('get_blog_setting', value)
-        return value
+    # 每个页面都会用到,只在后台保存设置时失效
+    return get_or_set_cache('get_blog_setting', _load_blog_setting, 60 * 60 * 3, single_flight=True)
+
+
+def _load_blog_setting():
+    from blog.models import BlogSettings
+    if not BlogSettings.objects.count():
+        setting = BlogSettings()
+        setting.site_name = 'djangoblog'
+        setting.site_description = '基于Django的博客系统'
+        setting.site_seo_description = '基于Django的博客系统'
+        setting.site_keywords = 'Django,Python'
+        setting.article_sub_length = 300
+        setting.sidebar_article_count = 10
+        setting.sidebar_comment_count = 5
+        setting.show_google_adsense = False
+        setting.open_site_comment = True
+        setting.analytics_code = ''
+        setting.beian_code = ''
+        setting.show_gongan_code = False
+        setting.comment_need_review = False
+        setting.save()
+    value = BlogSettings.objects.first()
+    logger.info('set cache get_blog_setting')
+    return value
 
 
 def save_user_avatar(url):
@@ -202,11 +578,8 @@ def save_user_avatar(url):
 
 
 def delete_sidebar_cache():
-    from blog.models import LinkShowType
-    keys = ["sidebar" + x for x in LinkShowType.values]
-    for k in keys:
-        logger.info('delete sidebar key:' + k)
-        cache.delete(k)
+    logger.info('invalidate sidebar cache')
+    invalidate_cache_tags('sidebar')
 
 
 def delete_view_cache(prefix, keys):
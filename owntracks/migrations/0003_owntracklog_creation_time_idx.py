@@ -0,0 +1,17 @@
+# Generated by Django 4.2.14 on 2026-10-17 04:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('owntracks', '0002_alter_owntracklog_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='owntracklog',
+            index=models.Index(fields=['creation_time'], name='owntracks_creation_time_idx'),
+        ),
+    ]
@@ -18,3 +18,6 @@ class OwnTrackLog(models.Model):
         verbose_name = "OwnTrackLogs"
         verbose_name_plural = verbose_name
         get_latest_by = 'creation_time'
+        indexes = [
+            models.Index(fields=['creation_time'], name='owntracks_creation_time_idx'),
+        ]
@@ -7,11 +7,16 @@ class CommandsAdmin(admin.ModelAdmin):
 
 
 class EmailSendLogAdmin(admin.ModelAdmin):
-    list_display = ('title', 'emailto', 'send_result', 'creation_time')
+    list_display = ('title', 'emailto', 'status', 'retry_count', 'creation_time')
+    list_filter = ('status',)
     readonly_fields = (
         'title',
         'emailto',
         'send_result',
+        'status',
+        'retry_count',
+        'next_retry_time',
+        'last_error',
         'creation_time',
         'content')
 
@@ -17,11 +17,12 @@ class BlogApi:
     def get_category_lists(self):
         return Category.objects.all()
 
+    # 微信回复需要从正文中取封面图片,卡片之外额外加载正文
     def get_category_articles(self, categoryname):
-        articles = Article.objects.filter(category__name=categoryname)
+        articles = Article.objects.filter(category__name=categoryname).cards('body')
         if articles:
             return articles[:self.__max_takecount__]
         return None
 
     def get_recent_articles(self):
-        return Article.objects.all()[:self.__max_takecount__]
+        return Article.objects.cards('body')[:self.__max_takecount__]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.14 on 2026-10-17 04:22
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def mark_existing_logs(apps, schema_editor):
+    # 已有的记录都是同步发送过的,不能再次进入发件箱
+    EmailSendLog = apps.get_model('servermanager', 'EmailSendLog')
+    EmailSendLog.objects.filter(send_result=True).update(status='sent')
+    EmailSendLog.objects.filter(send_result=False).update(status='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servermanager', '0002_alter_emailsendlog_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailsendlog',
+            name='last_error',
+            field=models.TextField(blank=True, default='', verbose_name='最后一次错误'),
+        ),
+        migrations.AddField(
+            model_name='emailsendlog',
+            name='next_retry_time',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='下次发送时间'),
+        ),
+        migrations.AddField(
+            model_name='emailsendlog',
+            name='retry_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='重试次数'),
+        ),
+        migrations.AddField(
+            model_name='emailsendlog',
+            name='status',
+            field=models.CharField(choices=[('pending', '待发送'), ('sent', '已发送'), ('failed', '发送失败')], default='pending', max_length=10, verbose_name='状态'),
+        ),
+        migrations.RunPython(mark_existing_logs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.14 on 2026-10-17 05:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servermanager', '0003_emailsendlog_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emailsendlog',
+            index=models.Index(fields=['status', 'next_retry_time'], name='servermanager_status_retry_idx'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils.timezone import now
 
 
 # Create your models here.
@@ -21,10 +22,27 @@ class commands(models.Model):
 
 
 class EmailSendLog(models.Model):
+    """邮件发件箱,待发送的邮件由 servermanager.outbox 批量发送"""
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, '待发送'),
+        (STATUS_SENT, '已发送'),
+        (STATUS_FAILED, '发送失败'),
+    )
+    # 最多重试次数,以及第一次重试的等待秒数,之后每次翻倍
+    MAX_RETRIES = 5
+    RETRY_DELAY = 60
+
     emailto = models.CharField('收件人', max_length=300)
     title = models.CharField('邮件标题', max_length=2000)
     content = models.TextField('邮件内容')
     send_result = models.BooleanField('结果', default=False)
+    status = models.CharField('状态', max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    retry_count = models.PositiveIntegerField('重试次数', default=0)
+    next_retry_time = models.DateTimeField('下次发送时间', default=now)
+    last_error = models.TextField('最后一次错误', blank=True, default='')
     creation_time = models.DateTimeField('创建时间', auto_now_add=True)
 
     def __str__(self):
@@ -34,3 +52,7 @@ class EmailSendLog(models.Model):
         verbose_name = '邮件发送log'
         verbose_name_plural = verbose_name
         ordering = ['-creation_time']
+        indexes = [
+            # 发件箱轮询待发送且到期的邮件
+            models.Index(fields=['status', 'next_retry_time'], name='servermanager_status_retry_idx'),
+        ]
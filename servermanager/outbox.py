@@ -0,0 +1,142 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils.timezone import now
+
+from djangoblog.utils import BackgroundFlusher
+
+logger = logging.getLogger(__name__)
+
+
+class EmailOutbox:
+    """
+    邮件发件箱
+    发送邮件时只写入EmailSendLog,由后台线程或 send_emails 命令批量取出,
+    复用同一个SMTP连接发送,失败的邮件按指数退避重试
+    """
+
+    def __init__(self, interval, batch_size=50, claim_timeout=600):
+        self.interval = interval
+        self.batch_size = batch_size
+        # 取出的邮件在这段时间内不会被其他进程再次取出,进程中途退出时到期后重新发送
+        self.claim_timeout = claim_timeout
+        self._flusher = BackgroundFlusher('email-outbox', self.flush, interval)
+
+    def put(self, emailto, title, content):
+        """
+        邮件写入发件箱
+        :return: EmailSendLog
+        """
+        from servermanager.models import EmailSendLog
+        log = EmailSendLog()
+        log.title = title
+        log.content = content
+        log.emailto = ','.join(emailto)
+        log.save()
+        if self.interval is None:
+            return log
+        if self.interval > 0:
+            self._flusher.start()
+            transaction.on_commit(self._flusher.wakeup)
+        else:
+            self.flush()
+        return log
+
+    def flush(self):
+        """
+        发送所有到期的待发送邮件
+        :return: (发送成功数, 发送失败数)
+        """
+        sent = failed = 0
+        connection = None
+        try:
+            while True:
+                logs = self._claim()
+                if not logs:
+                    break
+                if connection is None:
+                    connection = get_connection()
+                # SMTP发送不在事务中,避免SMTP服务器很慢时长时间占用数据库事务和行锁
+                results = self._send(connection, logs)
+                with transaction.atomic():
+                    for log, error in results:
+                        if error is None:
+                            self._sent(log)
+                            sent += 1
+                        else:
+                            self._retry(log, error)
+                            failed += 1
+        finally:
+            if connection is not None:
+                connection.close()
+        if sent or failed:
+            logger.info('send outbox emails:{sent} sent,{failed} failed'.format(
+                sent=sent, failed=failed))
+        return sent, failed
+
+    def _claim(self):
+        """
+        取出一批到期的待发送邮件,推迟它们的下次发送时间后提交,
+        多个进程同时发送时不会重复取出
+        """
+        from servermanager.models import EmailSendLog
+        with transaction.atomic():
+            queryset = EmailSendLog.objects.filter(
+                status=EmailSendLog.STATUS_PENDING,
+                next_retry_time__lte=now()).order_by('next_retry_time')
+            logs = list(queryset.select_for_update(skip_locked=True)[:self.batch_size])
+            if logs:
+                EmailSendLog.objects.filter(pk__in=[log.pk for log in logs]).update(
+                    next_retry_time=now() + timedelta(seconds=self.claim_timeout))
+        return logs
+
+    def _send(self, connection, logs):
+        """
+        :return: [(邮件, 错误)],发送成功时错误为None
+        """
+        try:
+            connection.open()
+        except Exception as e:
+            logger.error('open email connection error:{e}'.format(e=e))
+            return [(log, e) for log in logs]
+
+        results = []
+        for log in logs:
+            msg = EmailMultiAlternatives(
+                log.title,
+                log.content,
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                to=log.emailto.split(','),
+                connection=connection)
+            msg.content_subtype = "html"
+            try:
+                if not msg.send():
+                    raise ValueError('no email sent')
+            except Exception as e:
+                logger.error(f"失败邮箱号: {log.emailto}, {e}")
+                results.append((log, e))
+                continue
+            results.append((log, None))
+        return results
+
+    def _sent(self, log):
+        log.status = log.STATUS_SENT
+        log.send_result = True
+        log.last_error = ''
+        log.save(update_fields=['status', 'send_result', 'last_error'])
+
+    def _retry(self, log, error):
+        log.retry_count += 1
+        log.last_error = str(error)
+        if log.retry_count > log.MAX_RETRIES:
+            log.status = log.STATUS_FAILED
+        else:
+            delay = log.RETRY_DELAY * 2 ** (log.retry_count - 1)
+            log.next_retry_time = now() + timedelta(seconds=delay)
+        log.save(update_fields=['status', 'retry_count', 'last_error', 'next_retry_time'])
+
+
+email_outbox = EmailOutbox(settings.EMAIL_OUTBOX_FLUSH_INTERVAL)
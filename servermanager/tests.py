@@ -48,6 +48,13 @@ class ServerManagerTest(TestCase):
         rsp = recents(None, None)
         self.assertTrue(rsp != '暂时还没有文章')
 
+        # 文章列表只加载卡片字段和正文,回复中仍带有封面图片
+        from .robot import blogapi, convert_to_article_reply
+        article.body = "nicecontentccc ![](https://www.lylinux.net/cover.png)"
+        article.save()
+        reply = convert_to_article_reply(blogapi.get_recent_articles(), s)
+        self.assertIn('https://www.lylinux.net/cover.png', reply.render())
+
         cmd = commands()
         cmd.title = "test"
         cmd.command = "ls"
@@ -77,3 +84,49 @@ class ServerManagerTest(TestCase):
 
         s.content = 'exit'
         msghandler.handler()
+
+    def test_email_outbox(self):
+        from django.core import mail
+        from django.core.management import call_command
+        from djangoblog.utils import send_email
+        from .models import EmailSendLog
+        from .outbox import EmailOutbox
+
+        send_email(['qq@qq.com'], 'testTitle', 'testContent')
+        log = EmailSendLog.objects.get(title='testTitle')
+        self.assertEqual(log.status, EmailSendLog.STATUS_SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+        outbox = EmailOutbox(None)
+        log = outbox.put(['qq@qq.com'], 'retryTitle', 'retryContent')
+        self.assertEqual(log.status, EmailSendLog.STATUS_PENDING)
+        with self.settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                           EMAIL_HOST='127.0.0.1', EMAIL_PORT=1, EMAIL_USE_SSL=False,
+                           EMAIL_USE_TLS=False, EMAIL_TIMEOUT=1):
+            self.assertEqual(outbox.flush(), (0, 1))
+        log.refresh_from_db()
+        self.assertEqual(log.status, EmailSendLog.STATUS_PENDING)
+        self.assertEqual(log.retry_count, 1)
+        self.assertGreater(log.next_retry_time, timezone.now())
+        self.assertEqual(outbox.flush(), (0, 0))
+
+        log.next_retry_time = timezone.now()
+        log.save()
+        call_command('send_emails')
+        log.refresh_from_db()
+        self.assertEqual(log.status, EmailSendLog.STATUS_SENT)
+        self.assertEqual(len(mail.outbox), 2)
+
+        # 发送前已推迟下次发送时间并提交,发送期间其他进程不会重复取出
+        from unittest.mock import patch
+        log = outbox.put(['qq@qq.com'], 'claimTitle', 'claimContent')
+
+        def send():
+            self.assertEqual(outbox._claim(), [])
+            self.assertGreater(EmailSendLog.objects.get(pk=log.pk).next_retry_time, timezone.now())
+            return 1
+
+        with patch('servermanager.outbox.EmailMultiAlternatives.send', side_effect=send):
+            self.assertEqual(outbox.flush(), (1, 0))
+        log.refresh_from_db()
+        self.assertEqual(log.status, EmailSendLog.STATUS_SENT)